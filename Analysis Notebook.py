@@ -22,15 +22,20 @@ from sklearn.linear_model import LinearRegression
 import astropy.units as u
 from scipy.stats import spearmanr
 from matplotlib.ticker import MultipleLocator
-import subprocess
 from numba import jit, njit, prange
 from os import getcwd
-from os.path import isfile
+from os.path import isfile, isdir
 from scipy.integrate import quad
 import warnings
 import seaborn as sns
 from pathlib import Path
 from os.path import expanduser
+from mah_utils import t04_table, conc_table, last_index_above, open_mah_store, open_npz_store, save_derived, mar_windows
+from nth_kernels import integrate_sig2nth, thin_snapshots, t_bv, ks_dlnK_dlnr
+from fnth_emulator import build_emulator, emulate, error_bound, save_emulator, load_emulator
+from ks_profile import ks_norm_integral
+from model_mah_store import open_model_store, store_get, store_get_many, store_put
+from model_runner import run_models
 get_ipython().run_line_magic('matplotlib', 'inline')
 
 
@@ -282,24 +287,61 @@ def sig2_tot(r, M, z, conc_model='diemer19', mass_def='vir'):
 
 zhao_exec_name = 'mandc.x'
 vdb_exec_name = 'getPWGH'
+# outputs of both codes are kept in one store, see model_mah_store.py
+model_mah_db = open_model_store('model_mah.sqlite')
 
 # masses are mvir in Msun/h
 
 
-def zhao_mah(Mobs, z_obs, cosmo):
+def zhao_job(Mobs, z_obs, cosmo):
+    # model_runner job for one run of mandc.x
     lgMobs = np.log10(Mobs)
     zpt = '%05d' % (np.round(z_obs, decimals=1)*100)
     mpt = '%05d' % (np.round(lgMobs, decimals=1)*100)
     df_name = 'mchistory_%s.%s.%s' % (cosmo_dict[cosmo.name], zpt, mpt)
-    if(isfile(df_name)):  # we've already generated this run
-        data = np.loadtxt(df_name, skiprows=1)
+    instring = '%s\n%.3f %.3f\n1\n%.3f\n%.3f\n%.3f\n%.4f %1.3f\n1\n%1.1f\n%2.1f' % (
+        cosmo_dict[cosmo.name], cosmo.Om0, cosmo.Ode0, cosmo.H0/100., cosmo.sigma8, cosmo.ns, cosmo.Ob0, cosmo.Tcmb0, z_obs, lgMobs)
+    return ('%s/%s' % (getcwd(), zhao_exec_name), instring, df_name, {'skiprows': 1})
+
+
+def vdb_job(Mobs, z_obs, cosmo, tp='average'):
+    # model_runner job for one run of getPWGH
+    if(tp == 'median'):
+        med_or_avg = 0
+    elif(tp == 'average'):
+        med_or_avg = 1
+    instring = '%.3f\n%.3f\n%.3f\n%.3f\n%.4f\n%1.1E\n%1.1f\n%1d' % (
+        cosmo.Om0, cosmo.H0/100., cosmo.sigma8, cosmo.ns, cosmo.Ob0*(cosmo.H0/100.)**2, Mobs, z_obs, med_or_avg)
+    return ('%s/%s' % (getcwd(), vdb_exec_name), instring, 'PWGH_%s.dat' % tp, {})  # name used by Frank's code
+
+
+def model_mah_many(requests, model='vdb', nproc=None):
+    # raw output tables for a list of (Mobs, z_obs, cosmo, tp) requests: whatever is not in the store yet
+    # is run all at once, up to nproc executables at a time, and saved to the store as each one finishes
+    datas = [None] * len(requests)
+    groups = {}
+    for k, (Mobs, z_obs, cosmo, tp) in enumerate(requests):
+        groups.setdefault((z_obs, cosmo.name, tp), []).append(k)
+    for (z_obs, _, tp), ks in groups.items():  # one store query per (z, cosmology, tp)
+        found = store_get_many(model_mah_db, model, requests[ks[0]][2], tp, [requests[k][0] for k in ks], z_obs)
+        for k, data in zip(ks, found):
+            datas[k] = data
+    missing = [k for k, data in enumerate(datas) if data is None]
+    if(model == 'vdb'):
+        jobs = [vdb_job(*requests[k]) for k in missing]
     else:
-        instring = '%s\n%.3f %.3f\n1\n%.3f\n%.3f\n%.3f\n%.4f %1.3f\n1\n%1.1f\n%2.1f' % (
-            cosmo_dict[cosmo.name], cosmo.Om0, cosmo.Ode0, cosmo.H0/100., cosmo.sigma8, cosmo.ns, cosmo.Ob0, cosmo.Tcmb0, z_obs, lgMobs)
-        command = "echo '%s' | %s/%s" % (instring, getcwd(), zhao_exec_name)
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-        process.wait()
-        data = np.loadtxt(df_name, skiprows=1)
+        jobs = [zhao_job(*requests[k][:3]) for k in missing]
+
+    def save(i, data):
+        Mobs, z_obs, cosmo, tp = requests[missing[i]]
+        datas[missing[i]] = data
+        store_put(model_mah_db, model, cosmo, tp, Mobs, z_obs, data)
+    run_models(jobs, nproc, callback=save)
+    return datas
+
+
+def zhao_columns(data, cosmo):
+    # (z, M, c, dM/dt) from the raw mandc.x output, earliest snapshot first
     zeds = data[:, 0]
     mass = data[:, 1]
     conc = data[:, 2]
@@ -311,42 +353,58 @@ def zhao_mah(Mobs, z_obs, cosmo):
     out = np.flip(out, axis=0)
     return(out)
 
+
+def zhao_mah(Mobs, z_obs, cosmo):
+    data = store_get(model_mah_db, 'zhao', cosmo, 'average', Mobs, z_obs)
+    if(data is None):  # not in the store yet
+        df_name = zhao_job(Mobs, z_obs, cosmo)[2]
+        if(isfile(df_name)):  # file from before the store
+            data = np.loadtxt(df_name, skiprows=1)
+            store_put(model_mah_db, 'zhao', cosmo, 'average', Mobs, z_obs, data)
+        else:
+            data = model_mah_many([(Mobs, z_obs, cosmo, 'average')], 'zhao')[0]
+    return zhao_columns(data, cosmo)
+
 # same units for both, dM/dt in Msun/h / Gyr, mass in Msun/h:
 
 
-def vdb_mah(Mobs, z_obs, cosmo, tp='average', return_sigma_D=False):
-    if(tp == 'median'):
-        med_or_avg = 0
-    elif(tp == 'average'):
-        med_or_avg = 1
-    df_out_name = 'PWGH_%s.dat' % tp  # name used by Frank's code
-    lgMobs = np.log10(Mobs)
-    zpt = '%05d' % (np.round(z_obs, decimals=1)*100)
-    mpt = '%09d' % (int(lgMobs*1e7))
-    # name we will save file as
-    df_name = 'PWGH_%s.%s.%s' % (cosmo_dict[cosmo.name], zpt, mpt)
-    if(isfile(df_name) and return_sigma_D == False):  # we've already generated this run
-        data = np.loadtxt(df_name)
-    else:
-        instring = '%.3f\n%.3f\n%.3f\n%.3f\n%.4f\n%1.1E\n%1.1f\n%1d' % (
-            cosmo.Om0, cosmo.H0/100., cosmo.sigma8, cosmo.ns, cosmo.Ob0*(cosmo.H0/100.)**2, Mobs, z_obs, med_or_avg)
-        command = "echo '%s' | %s/%s; mv %s %s" % (
-            instring, getcwd(), vdb_exec_name, df_out_name, df_name)
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-        process.wait()
-        data = np.loadtxt(df_name)
+def vdb_columns(data, Mobs):
+    # (z, M, c, dM/dt) from the raw getPWGH output, earliest snapshot first
     zeds = data[:, 1]
     mass = 10**data[:, 3] * Mobs
     conc = data[:, 6]
     dMdt = data[:, 7] * yr_per_Gyr
     out = np.column_stack((zeds, mass, conc, dMdt))
-    out = np.flip(out, axis=0)
+    return np.flip(out, axis=0)
+
+
+def vdb_mah(Mobs, z_obs, cosmo, tp='average', return_sigma_D=False):
+    lgMobs = np.log10(Mobs)
+    zpt = '%05d' % (np.round(z_obs, decimals=1)*100)
+    mpt = '%09d' % (int(lgMobs*1e7))
+    # name the runs were saved as before the store
+    df_name = 'PWGH_%s.%s.%s' % (cosmo_dict[cosmo.name], zpt, mpt)
+    data = None if return_sigma_D else store_get(model_mah_db, 'vdb', cosmo, tp, Mobs, z_obs)
+    if(data is None):
+        if(isfile(df_name) and return_sigma_D == False):
+            data = np.loadtxt(df_name)
+            store_put(model_mah_db, 'vdb', cosmo, tp, Mobs, z_obs, data)
+        else:
+            data = run_models([vdb_job(Mobs, z_obs, cosmo, tp)])[0]
+            store_put(model_mah_db, 'vdb', cosmo, tp, Mobs, z_obs, data)
+    out = vdb_columns(data, Mobs)
     if(return_sigma_D == False):
         return(out)
     else:
         return out, data[:, 8][::-1], data[:, 9][::-1]
 
 
+def vdb_mah_many(masses, z_obs, cosmo, tp='average'):
+    # vdb_mah for a grid of masses, running the missing ones concurrently
+    datas = model_mah_many([(m, z_obs, cosmo, tp) for m in masses], 'vdb')
+    return [vdb_columns(data, m) for m, data in zip(masses, datas)]
+
+
 # In[25]:
 
 
@@ -359,11 +417,12 @@ nm = 30
 masses = np.logspace(11.5, 16, nm)  # just to cover full range
 concs = np.zeros(nm)
 conc_interps = {}
+# every (z, M) run at once, so the model executables run concurrently
+datas = model_mah_many([(m, z, cosmo, 'average') for z in zeds for m in masses], 'vdb')
 loglogplot()
 for j, z in enumerate(zeds):
-    for i, m in enumerate(masses):
-        dat = vdb_mah(m, z, cosmo)
-        concs[i] = dat[-1, 2]
+    for i in range(nm):
+        concs[i] = vdb_columns(datas[j*nm + i], masses[i])[-1, 2]
     conc_interps[z] = interp(masses, concs)
 
     plt.plot(masses, concs, label=r'%.2f' % z)
@@ -434,34 +493,19 @@ def t_d(r, M, z, c, R, beta=beta_def):
 
 
 def t_BV(r, M, z, c, R, fnth, gamma, beta):
-    g = -G*M * NFWf(c*r/R) / (NFWf(c) * r**2)
-    Gm = Gamma(c)
-    phi0 = -1. * (c / NFWf(c))
-    phir = -1. * (c / NFWf(c)) * (np.log(1. + c*r/R) / (c*r/R))
-    theta = 1. + ((Gm - 1.) / Gm) * 3. * eta0(c)**-1 * (phi0 - phir)
-    lnK = ((Gm - gamma) / (Gm - 1.) * np.log(theta)) +        np.log(1. - fnth)
-    lnK_interp = interp(r, lnK)
-    dlnK_dr = lnK_interp.derivative(1)
-    N_BV = np.sqrt(-1. * g / gamma * dlnK_dr(r))
-    return beta * 1. / N_BV * km_per_kpc / (cosmology.getCurrent().H0 / 100.) / s_per_Gyr
+    # r has to be log-spaced; finite differences in ln r on that grid, see t_bv in nth_kernels.py
+    # NaN where the gas is convectively unstable, as the spline version gave
+    return t_bv(r, M, c, R, fnth, beta, cosmology.getCurrent().H0 / 100., gamma, unstable=np.nan)
 
 
 def dlnK_dlnr(r, M, z, c, R, fnth, gamma, beta):
-    g = -G*M * NFWf(c*r/R) / (NFWf(c) * r**2)
-    Gm = Gamma(c)
-    phi0 = -1. * (c / NFWf(c))
-    phir = -1. * (c / NFWf(c)) * (np.log(1. + c*r/R) / (c*r/R))
-    theta = 1. + ((Gm - 1.) / Gm) * 3. * eta0(c)**-1 * (phi0 - phir)
-    lnK = ((Gm - gamma) / (Gm - 1.) * np.log(theta)) +        np.log(1. - fnth)
-    lnK_interp = interp(np.log(r), lnK)
-    dlnK_dlnr = lnK_interp.derivative(1)
-    return(dlnK_dlnr(np.log(r)))
+    return ks_dlnK_dlnr(r, c, R, fnth, gamma)
 
 #takes in Mobs, zobs, cosmo
 # returns f_nth, sig2nth, sig2tot at z=zobs
 
 
-def gen_fnth(Mobs, zobs, cosmo, mah_retriever=vdb_mah, mass_def='vir', conc_model='duffy08', beta=beta_def, eta=eta_def, nrads=30, zi=30., r_mult=1., timescale='td', init_eta=eta_def, conc_test_flag=False, psires=1e-4, dsig_pos=False, return_full=False):
+def gen_fnth(Mobs, zobs, cosmo, mah_retriever=vdb_mah, mass_def='vir', conc_model='duffy08', beta=beta_def, eta=eta_def, nrads=30, zi=30., r_mult=1., timescale='td', init_eta=eta_def, conc_test_flag=False, psires=1e-4, dsig_pos=False, return_full=False, scheme='euler', thin=1):
     data = mah_retriever(Mobs, zobs, cosmo)
     # This below is defunct, we switched to setting initial time based on m/M0
     #first_snap_to_use = np.where(data[:,0] <= zi)[0][0] - 1
@@ -475,6 +519,23 @@ def gen_fnth(Mobs, zobs, cosmo, mah_retriever=vdb_mah, mass_def='vir', conc_mode
 
     rads = np.logspace(np.log10(0.01*Robs), np.log10(r_mult*Robs), nrads)
 
+    if(timescale == 'td' and return_full == False and conc_test_flag == False):
+        # only the final profiles are needed, so use the compiled kernel shared with gen_obs
+        # beta_def as in the loop below
+        zeds = data[:, 0]
+        masses = data[:, 1]
+        Rs = mass_so.M_to_R(masses, zeds, mass_def)
+        if(conc_model == 'vdb'):
+            concs = data[:, 2]
+        else:
+            concs = np.array([concentration.concentration(
+                m, mass_def, z, model=conc_model) for m, z in zip(masses, zeds)])
+        # scheme='exp' and thin > 1 give the exponential integrator on every thin-th snapshot, see nth_kernels.py
+        sig2nth, sig2tot = integrate_sig2nth(masses, concs, Rs, np.diff(cosmo.age(zeds)), rads,
+                                             cosmo.H0 / 100., beta_def, eta, init_eta, dsig_pos, scheme, thin)
+        return sig2nth / sig2tot, rads, sig2nth, sig2tot, data[-1, 0], data[-1, 2]
+    assert scheme == 'euler' and thin == 1 # only the kernel has the other integrators
+
     ds2dt = np.zeros((n_steps, nrads))
     sig2tots = np.zeros((n_steps, nrads))
     sig2nth = np.zeros((n_steps, nrads))
@@ -538,6 +599,47 @@ def gen_fnth(Mobs, zobs, cosmo, mah_retriever=vdb_mah, mass_def='vir', conc_mode
         return fnth, rads, sig2nth[-1, :], sig2tots[-1, :], data[:, 0], data[:, 2]
 
 
+def gen_fnth_many(Mobs, zobs, cosmo, mah_retriever=vdb_mah, mass_def='vir', conc_model='duffy08', beta=beta_def, eta=eta_def, nrads=30, r_mult=1., init_eta=eta_def, psires=1e-4, dsig_pos=False, scheme='euler', thin=1):
+    '''
+    gen_fnth (timescale='td', final profiles only) for arrays of Mobs and zobs (broadcast) in one
+    kernel call. The MAHs are cut at psires and thinned each on its own as in gen_fnth, then padded
+    at the front onto a shared snapshot axis, with each halo starting at its own first snapshot.
+    Returns fnth, rads, sig2nth, sig2tot as (halo, radius) arrays, and the final z and c of each halo.
+    '''
+    Mobs, zobs = np.broadcast_arrays(np.atleast_1d(np.asarray(Mobs, dtype=float)), np.asarray(zobs, dtype=float))
+    if(mah_retriever == vdb_mah):  # run the missing model MAHs together
+        datas = [vdb_columns(data, m) for m, data in zip(Mobs, model_mah_many(
+            [(m, z, cosmo, 'average') for m, z in zip(Mobs, zobs)], 'vdb'))]
+    else:
+        datas = [mah_retriever(m, z, cosmo) for m, z in zip(Mobs, zobs)]
+    for k, data in enumerate(datas):
+        data = data[np.where(data[:, 1]/Mobs[k] >= psires)[0][0]:]
+        if(thin > 1):
+            data = data[thin_snapshots(len(data), thin)]
+        datas[k] = data
+
+    nsnap = max(len(data) for data in datas)
+    first = np.array([nsnap - len(data) for data in datas])
+    # padded with copies of the first snapshot, which the kernel never reads
+    padded = np.array([np.concatenate((np.repeat(data[:1], nsnap - len(data), axis=0), data)) for data in datas])
+    zeds = padded[:, :, 0]
+    masses = padded[:, :, 1]
+    Rs = mass_so.M_to_R(masses, zeds, mass_def)
+    if(conc_model == 'vdb'):
+        concs = padded[:, :, 2]
+    else:
+        concs = np.array([[concentration.concentration(m, mass_def, z, model=conc_model)
+                           for m, z in zip(masses[k], zeds[k])] for k in range(len(datas))])
+    dt = np.diff(cosmo.age(zeds), axis=1)
+
+    Robs = mass_so.M_to_R(Mobs, zobs, mass_def)
+    rads = np.logspace(np.log10(0.01*Robs), np.log10(r_mult*Robs), nrads, axis=-1)
+    # beta_def as in gen_fnth
+    sig2nth, sig2tot = integrate_sig2nth(masses, concs, Rs, dt, rads, cosmo.H0 / 100., beta_def, eta,
+                                         init_eta, dsig_pos, scheme, first=first)
+    return sig2nth / sig2tot, rads, sig2nth, sig2tot, zeds[:, -1], padded[:, -1, 2]
+
+
 # In[28]:
 
 
@@ -670,13 +772,16 @@ def compute_fitting_func(cosmo, mah_retriever=vdb_mah, mass_def='vir', conc_mode
     fnth_arr = []
     nu_arr = []
 
+    m200ms = np.array([peaks.massFromPeakHeight(nu, zobs) for nu in nu_200m])
+    # converting to m_vir from m_200m
+    mvirs = np.array([vir_from_other(m200m, 200, 'm', zobs, cosmo) for m200m in m200ms])
+    # every nu in one call
+    fnths, radss, _, _, zz, conc = gen_fnth_many(
+        mvirs, zobs, cosmo, mah_retriever, mass_def, conc_model, beta, eta, r_mult=r_mult)
+
     for i, nu in enumerate(nu_200m):
-        m200m = peaks.massFromPeakHeight(nu, zobs)
-        # converting to m_vir from m_200m
-        mvir = vir_from_other(m200m, 200, 'm', zobs, cosmo)
-        fnth, rads, _, _, zz, conc = gen_fnth(
-            mvir, zobs, cosmo, mah_retriever, mass_def, conc_model, beta, eta, r_mult=r_mult, zi=30.)
-        r200m = mass_so.M_to_R(m200m, zobs, '200m')
+        fnth, rads = fnths[i], radss[i]
+        r200m = mass_so.M_to_R(m200ms[i], zobs, '200m')
         msk = rads / r200m <= 2.0
         rad_arr.extend(rads[msk]/r200m)
         fnth_arr.extend(fnth[msk])
@@ -727,6 +832,45 @@ plt.ylabel(r'Fractional Error')
 # it does good enough for the purposes of any analysis at this stage in f_nth research
 
 
+# In[ ]:
+
+
+# tabulated f_nth(r/r200m, nu_200m, z) emulator, built once per cosmology from the full model
+# an alternative to refitting fnth_fit with curve_fit, see fnth_emulator.py for the error bounds
+
+
+def fnth_profile(nu, zobs, x, cosmo, mah_retriever=vdb_mah, mass_def='vir', conc_model='vdb', beta=beta_def, eta=eta_def):
+    # f_nth at r/r200m = x for the halo with peak height nu_200m at zobs, as in compute_fitting_func
+    m200m = peaks.massFromPeakHeight(nu, zobs)
+    mvir = vir_from_other(m200m, 200, 'm', zobs, cosmo)
+    fnth, rads, _, _, zz, conc = gen_fnth(
+        mvir, zobs, cosmo, mah_retriever, mass_def, conc_model, beta, eta, nrads=200, r_mult=3., zi=30.)
+    r200m = mass_so.M_to_R(m200m, zobs, '200m')
+    return interp(np.log(rads / r200m), fnth)(np.log(x))
+
+
+def build_fnth_emulator(cosmo, nu_200m=np.linspace(1.0, 4.2, 33), zobs=None, x=np.logspace(np.log10(0.02), np.log10(2.), 100), **kwargs):
+    # zobs defaults to the redshifts of conc_interps, which vir_from_other needs
+    zobs = sorted(conc_interps) if zobs is None else zobs
+    emu = build_emulator(lambda nu, z, x: fnth_profile(nu, z, x, cosmo, **kwargs), x, nu_200m, zobs,
+                         cosmology=cosmo.name, beta=kwargs.get('beta', beta_def), eta=kwargs.get('eta', eta_def))
+    save_emulator('fnth_emulator_%s.npz' % cosmo.name, emu)
+    return emu
+
+
+cosmo = cosmology.setCosmology('planck18')
+if(isfile('fnth_emulator_%s.npz' % cosmo.name)):
+    emu = load_emulator('fnth_emulator_%s.npz' % cosmo.name)
+else:
+    emu = build_fnth_emulator(cosmo)
+
+# same points as the fnth_fit accuracy check above
+msk = in_arr[:, 0] >= 0.02
+emu_err = emulate(emu, in_arr[msk, 0], in_arr[msk, 1], 1.0) - fnth_arr[msk]
+print('emulator max |error| = %.2e, stored bound = %.2e, fnth_fit max |error| = %.2e' % (
+    np.max(np.abs(emu_err)), error_bound(emu, 1.0), np.max(np.abs(pred_arr - fnth_arr))))
+
+
 # In[48]:
 
 
@@ -752,16 +896,25 @@ def plot_fixed_nu_fixed_M(masses_200m, zeds, cosmo, mah_retriever=vdb_mah, mass_
     zobs = 0
     cols = sns.cubehelix_palette(len(zeds))
 
+    # fixed nu_200m (right) and fixed M_200m (left) haloes for every mass and redshift, converted to m_vir
+    # from m_200m based on Zhao+09 concentrations, then one gen_fnth_many call per panel column
+    nu200ms = np.array([peaks.peakHeight(m200m, zobs) for m200m in masses_200m])
+    m200m_nu = np.array([[peaks.massFromPeakHeight(nu200m, z) for z in zeds] for nu200m in nu200ms])
+    mvir_nu = np.array([[vir_from_other(m200m_nu[i, j], 200, 'm', z, cosmo) for j, z in enumerate(zeds)]
+                        for i in range(len(masses_200m))])
+    mvir_m = np.array([[vir_from_other(m200m, 200, 'm', z, cosmo) for z in zeds] for m200m in masses_200m])
+    z_grid = np.broadcast_to(zeds, mvir_nu.shape)
+    fnth_nu, rads_nu, _, _, _, _ = gen_fnth_many(
+        mvir_nu.ravel(), z_grid.ravel(), cosmo, mah_retriever, mass_def, conc_model, beta, eta, r_mult=r_mult, init_eta=init_eta, psires=psires)
+    fnth_m, rads_m, _, _, _, _ = gen_fnth_many(
+        mvir_m.ravel(), z_grid.ravel(), cosmo, mah_retriever, mass_def, conc_model, beta, eta, r_mult=r_mult, init_eta=init_eta)
+
     for i, m200m in enumerate(masses_200m):
-        nu200m = peaks.peakHeight(m200m, zobs)  # fixed nu_200m
+        nu200m = nu200ms[i]  # fixed nu_200m
         for j, z in enumerate(zeds):
-            # since we put in M_vir, this is still M_vir
-            m200m_newZ = peaks.massFromPeakHeight(nu200m, z)
-            # converting to m_vir from m_200m, based on Zhao+09 concentrations
-            mvir = vir_from_other(m200m_newZ, 200, 'm', z, cosmo)
-            fnth, rads, _, _, zz, conc = gen_fnth(
-                mvir, z, cosmo, mah_retriever, mass_def, conc_model, beta, eta, r_mult=r_mult, zi=30., init_eta=init_eta, psires=psires)
-            r200m = mass_so.M_to_R(m200m_newZ, z, '200m')
+            k = i*len(zeds) + j
+            fnth, rads = fnth_nu[k], rads_nu[k]
+            r200m = mass_so.M_to_R(m200m_nu[i, j], z, '200m')
             if(j == 0):
                 ax[i, 1].text(
                     0.1, 0.5, r'Fixed $\nu_\mathrm{200m} = %.2f$' % nu200m, fontsize=16)
@@ -771,10 +924,7 @@ def plot_fixed_nu_fixed_M(masses_200m, zeds, cosmo, mah_retriever=vdb_mah, mass_
                           z, color=cols[::-1][j])
 
             # now we need to do fixed mass on the left panel
-            # converting from m_200m at z=0 to m_vir at each redshift
-            mvir = vir_from_other(m200m, 200, 'm', z, cosmo)
-            fnth, rads, _, _, zz, conc = gen_fnth(
-                mvir, z, cosmo, mah_retriever, mass_def, conc_model, beta, eta, r_mult=r_mult, init_eta=init_eta)
+            fnth, rads = fnth_m[k], rads_m[k]
             r200m = mass_so.M_to_R(m200m, z, '200m')
             ax[i, 0].plot(rads/r200m, fnth, label='$%.1f$' %
                           np.log10(m200m), color=cols[::-1][j])
@@ -837,16 +987,20 @@ def plot_hse_bias(mah_retriever=vdb_mah, mass_def='vir', conc_model='vdb', beta=
 
     cols = sns.cubehelix_palette(len(zeds))
 
+    # convert from M500c to Mvir
+    mvirs = np.array([[vir_from_other(m500c, 500, 'c', zobs, cosmo, r_other_mult_max=2.5)
+                       for m500c in m500c_vals] for zobs in zeds])
+    # f_nth of every (z, M500c) halo in one call
+    fnths, radss, _, sig2tots_all, _, concs = gen_fnth_many(
+        mvirs.ravel(), np.repeat(zeds, nm), cosmo, mah_retriever, mass_def, conc_model, beta, eta, r_mult=r_mult, nrads=200)
+
     for i, zobs in enumerate(zeds):
         ratios_500c = np.zeros(nm)
         for j, m500c in enumerate(m500c_vals):
-
-            # convert from M500c to Mvir
-            mvir = vir_from_other(m500c, 500, 'c', zobs,
-                                  cosmo, r_other_mult_max=2.5)
+            mvir = mvirs[i, j]
             r500c = mass_so.M_to_R(m500c, zobs, '500c')
-            fnth, rads, sig2nth, sig2tots, zz, conc = gen_fnth(
-                mvir, zobs, cosmo, mah_retriever, mass_def, conc_model, beta, eta, r_mult=r_mult, nrads=200, return_full=False, zi=30.)
+            k = i*nm + j
+            fnth, rads, sig2tots, conc = fnths[k], radss[k], sig2tots_all[k], concs[k]
 
             # for computing the enclosed mass out to arbitrary radii
             rhos, rs = profile_nfw.NFWProfile.fundamentalParameters(
@@ -859,7 +1013,6 @@ def plot_hse_bias(mah_retriever=vdb_mah, mass_def='vir', conc_model='vdb', beta=
                            nfw_prof(x, rhos, rs), 0, 2.0*r200m)[0]
 
             # compute rho_gas profile, use it to compute M_gas within Rdef and T_mgas within Rdef
-            rho0_by_P0 = 3*eta0(conc)**-1 * Rvir/(G*m)
             phi0 = -1. * (conc / NFWf(conc))
             def phir(rad): return -1. * (conc / NFWf(conc)) *                 (np.log(1. + conc*rad/Rvir) / (conc*rad/Rvir))
 
@@ -867,8 +1020,9 @@ def plot_hse_bias(mah_retriever=vdb_mah, mass_def='vir', conc_model='vdb', beta=
                                          Gamma(conc)) * 3. * eta0(conc)**-1 * (phi0 - phir(rad))
             cbf = cosmo.Ob0 / cosmo.Om0
             rho0_nume = nume = cbf * M2R200m
-            rho0_denom = 4. * np.pi *                 quad(lambda x: theta(x)**(1.0 / (Gamma(conc) - 1.0))
-                     * x**2, 0, 2.0*r200m)[0]
+            # 4 pi int_0^2R200m theta^(1/(Gamma-1)) r^2 dr, from the table over concentration in ks_profile.py
+            rho0_denom = 4. * np.pi * Rvir**3 * \
+                ks_norm_integral(conc, 2.0*r200m / Rvir)
             # This now pegs the gas mass to be equal to cosmic baryon fraction at 2R500m
             # NOTE: Both rho0_nume and rho_denom need to be changed if the radius is changed
             rho0 = rho0_nume / rho0_denom
@@ -918,15 +1072,12 @@ def multimah(Mobs, z_obs, cosmo, Nmah, tp='average'):
     z_int = int(z_obs*100)
     mah_dir = multimah_root / ('%s/m%03d/z%03d' %
                                (cosmo.name, mass_int, z_int))
-    dat1 = np.loadtxt(mah_dir / 'MAH0001.dat')
-    redshifts = dat1[:, 1]
-    lbtime = dat1[:, 2]
-    nz = len(dat1)
-    dat = np.zeros((Nmah, nz))
+    store = open_mah_store(mah_dir, Nmah)
+    redshifts = np.array(store['redshifts'])
+    lbtime = np.array(store['lbtime'])
+    nz = len(redshifts)
+    dat = store['mah'][:Nmah]
     std = np.zeros((nz, 2))
-    for i in range(0, Nmah):
-        dat[i, :] = np.loadtxt(mah_dir / ('MAH%04d.dat' % (i+1)), usecols=3)
-    dat = 10**dat
     if(tp == 'full'):
         # return the full array instead of giving standard deviations
         return dat*Mobs, redshifts, lbtime
@@ -1066,6 +1217,48 @@ def compute_fit(masses, obs, zero_point=1.):
     return coeffs[0], coeffs[1], pc_scatter, pc_rbscatter, scatter, robust_scatter
 
 
+def compute_fits(data, msk, zero_point=1.):
+    '''
+    compute_fit for every observable data[j] against the mass data[0], at every aperture, in one go.
+    data is the (5, Nmah, nap) cube from gen_obs (or a slice of its apertures), msk is (Nmah,)
+    or (nmsk, Nmah) for several halo selections at once. The regressions are solved in closed form
+    (the same least squares as np.polyfit), over all observables and apertures together.
+    Returns slopes, norms, pc_scatters, pc_rbscatters, scatters, rbscatters as in compute_fit,
+    each (5, nap), or (nmsk, 5, nap); row j is observable j, row 0 is the trivial M-M fit.
+    '''
+    msk = np.asarray(msk, dtype=bool)
+    out = np.zeros((6, len(np.atleast_2d(msk)), data.shape[0], data.shape[2]))
+    for i, m in enumerate(np.atleast_2d(msk)):
+        x = np.log10(data[0, m] / zero_point)  # (n, nap)
+        y = np.log10(data[:, m])  # (5, n, nap)
+        xm = x.mean(axis=0)
+        ym = y.mean(axis=1)
+        dx = x - xm
+        slopes = (dx * (y - ym[:, None])).sum(axis=1) / (dx**2).sum(axis=0)
+        norms = ym - slopes * xm
+        # ln(pred / obs), offset from compute_fit's by a constant that drops out of the scatters
+        resids = np.log(10.) * (slopes[:, None] * x + norms[:, None] - y)
+        scatters = np.std(resids, axis=1)
+        p16, p84 = np.percentile(resids, [16, 84], axis=1)
+        rbscatters = (p84 - p16) / 2.0
+        out[:, i] = slopes, norms, 100. * scatters, 100. * rbscatters, scatters, rbscatters
+    if(msk.ndim == 1):
+        return tuple(out[:, 0])
+    return tuple(out)
+
+
+# the gen_obs data cubes, each read once and shared (read-only) between the plots
+_obs_data = {}
+
+
+def load_obs_data(fn):
+    if(fn not in _obs_data):
+        data = np.load(obs_data_dir / fn)['data']
+        data.flags.writeable = False
+        _obs_data[fn] = data
+    return _obs_data[fn]
+
+
 radii_definitions = [('vir', 1), ('500c', 1), ('500c', 2), ('500c', 3), ('500c', 4), ('500c', 5),
                      ('200m', 0.3), ('200m', 0.5), ('200m',
                                                     0.875), ('200m', 1.0), ('200m', 1.25),
@@ -1128,26 +1321,19 @@ def plot_3x1_means_varyCosm():
     for i, cs in enumerate(cosmos):
         cosmo = cosmology.setCosmology(cs)
         # load in the data
-        data = np.load(obs_data_dir / ('%s_data.npz' % cs))['data']
+        data = load_obs_data('%s_data.npz' % cs)
+
+        # every observable at the radii that are r200m multiples in one fit
+        mult = np.array([radii_definitions[k][1] for k in range(6, 13)])
+        msk = data[0, :, 9] > 1e14
+        slopes, norms, pc_scatters, pc_rbscatters, scatters, rbscatters = compute_fits(
+            data[:, :, 6:13], msk, zero_point=10**14)
 
         # loop over observables (mass_enc, Tmgasv, Mgasv, YSZv)
         for j in range(3, 4):
-            # loop over the radius, these will be the r200m multiples
-            mult = np.zeros(7)
-            slopes = np.zeros(7)
-            norms = np.zeros(7)
-            pc_scatters = np.zeros(7)
-            pc_rbscatters = np.zeros(7)
-            rbscatters = np.zeros(7)
-            scatters = np.zeros(7)
-            msk = data[0, :, 9] > 1e14
-            for k in range(6, 13):
-                mult[k-6] = radii_definitions[k][1]
-                slopes[k-6], norms[k-6], pc_scatters[k-6], pc_rbscatters[k-6], scatters[k-6], rbscatters[k-6] = compute_fit(
-                    data[0, msk, k], data[j, msk, k], zero_point=10**14)
-            scat_interp = interp(mult, pc_rbscatters)
-            slope_interp = interp(mult, slopes)
-            norm_interp = interp(mult, norms)
+            scat_interp = interp(mult, pc_rbscatters[j])
+            slope_interp = interp(mult, slopes[j])
+            norm_interp = interp(mult, norms[j])
             mult_arr = np.linspace(0.3, 2.0, 60)
             ax[0].plot(mult_arr, scat_interp(mult_arr),
                        color=current_palette[i], label=fancy_cosmos[i])
@@ -1212,8 +1398,7 @@ def plot_3x3_means_varyComplexity():
     # loop over cosmology
     for i, direct in enumerate(['', '_fixedc', '_fixedc_fixedT']):
         # load in the data
-        data = np.load(
-            obs_data_dir / ('redshifts%s/z000_data.npz' % direct))['data']
+        data = load_obs_data('redshifts%s/z000_data.npz' % direct)
 
         # temporary check when I added in Y_{SZ}(r spherical) to understand projection effects
         # if(i==0):
@@ -1221,30 +1406,24 @@ def plot_3x3_means_varyComplexity():
         #    data[3] = data[4]
         #    data[4] = tmp
 
+        # every observable at the radii that are r200m multiples in one fit
+        mult = np.array([radii_definitions[k][1] for k in range(6, 13)])
+        msk = data[0, :, 9] > 1e14
+        slopes, norms, pc_scatters, pc_rbscatters, scatters, rbscatters = compute_fits(
+            data[:, :, 6:13], msk, zero_point=10**14)
+
         # loop over observables (mass_enc, Tmgasv, Mgasv, YSZv)
         for j in range(1, 4):
-            # loop over the radius, these will be the r200m multiples
-            mult = np.zeros(7)
-            slopes = np.zeros(7)
-            norms = np.zeros(7)
-            pc_scatters = np.zeros(7)
-            pc_rbscatters = np.zeros(7)
-            rbscatters = np.zeros(7)
-            scatters = np.zeros(7)
-            msk = data[0, :, 9] > 1e14
-            for k in range(6, 13):
-                mult[k-6] = radii_definitions[k][1]
-                slopes[k-6], norms[k-6], pc_scatters[k-6], pc_rbscatters[k-6], scatters[k-6], rbscatters[k-6] = compute_fit(
-                    data[0, msk, k], data[j, msk, k], zero_point=10**14)
-                # test to estimate enhanced scatter due to realistic Mgas, as requested by Gus
-                if(j == 3 and i == 0):
-                    # Tmgasv
-                    sigY = np.sqrt(
-                        rbscatters[k-6]**2. + (0.036)**2. + (2. * 0.48 * rbscatters[k-6]*0.036))
-                    print('Mgas-enhanced scatter at r200m multiple in YSZ', mult[k-6], sigY)
-            scat_interp = interp(mult, pc_rbscatters)
-            slope_interp = interp(mult, slopes)
-            norm_interp = interp(mult, norms)
+            # test to estimate enhanced scatter due to realistic Mgas, as requested by Gus
+            if(j == 3 and i == 0):
+                # Tmgasv
+                sigY = np.sqrt(
+                    rbscatters[j]**2. + (0.036)**2. + (2. * 0.48 * rbscatters[j]*0.036))
+                for k in range(0, 7):
+                    print('Mgas-enhanced scatter at r200m multiple in YSZ', mult[k], sigY[k])
+            scat_interp = interp(mult, pc_rbscatters[j])
+            slope_interp = interp(mult, slopes[j])
+            norm_interp = interp(mult, norms[j])
             mult_arr = np.linspace(0.3, 2.0, 60)
             ax[0, j-1].plot(mult_arr, scat_interp(mult_arr),
                             color=cols[i], label=labs[i])
@@ -1308,31 +1487,22 @@ def plot_projections():
     # loop over cosmology
     for i, direct in enumerate(['']):
         # load in the data
-        data = np.load(
-            obs_data_dir / ('redshifts%s/z000_data.npz' % direct))['data']
+        data = load_obs_data('redshifts%s/z000_data.npz' % direct)
         if(i == 0):
-            tmp = data[3].copy()
-            data[3] = data[4]
-            data[4] = tmp
+            # swapped copy, the loaded cube is shared
+            data = data[[0, 1, 2, 4, 3]]
+
+        # every observable at the radii that are r200m multiples in one fit
+        mult = np.array([radii_definitions[k][1] for k in range(6, 13)])
+        msk = data[0, :, 9] > 1e14
+        slopes, norms, pc_scatters, pc_rbscatters, scatters, rbscatters = compute_fits(
+            data[:, :, 6:13], msk, zero_point=10**14)
 
         # loop over observables (mass_enc, Tmgasv, Mgasv, YSZv)
         for j in range(1, 4):
-            # loop over the radius, these will be the r200m multiples
-            mult = np.zeros(7)
-            slopes = np.zeros(7)
-            norms = np.zeros(7)
-            pc_scatters = np.zeros(7)
-            pc_rbscatters = np.zeros(7)
-            rbscatters = np.zeros(7)
-            scatters = np.zeros(7)
-            msk = data[0, :, 9] > 1e14
-            for k in range(6, 13):
-                mult[k-6] = radii_definitions[k][1]
-                slopes[k-6], norms[k-6], pc_scatters[k-6], pc_rbscatters[k-6], scatters[k-6], rbscatters[k-6] = compute_fit(
-                    data[0, msk, k], data[j, msk, k], zero_point=10**14)
-            scat_interp = interp(mult, pc_rbscatters)
-            slope_interp = interp(mult, slopes)
-            norm_interp = interp(mult, norms)
+            scat_interp = interp(mult, pc_rbscatters[j])
+            slope_interp = interp(mult, slopes[j])
+            norm_interp = interp(mult, norms[j])
             mult_arr = np.linspace(0.3, 2.0, 60)
             ax[j-1].plot(mult_arr, slope_interp(mult_arr),
                          color=cols[i], label=labs[i])
@@ -1385,24 +1555,15 @@ def plot_3x3_means_varyZ():
     # loop over cosmology
     for i, z in enumerate(zeds):
         # load in the data
-        data = np.load(
-            obs_data_dir / ('redshifts/z%03d_data.npz' % int(100*z)))['data']
-
-        mult = np.zeros(7)
-        slopes = np.zeros(7)
-        norms = np.zeros(7)
-        pc_scatters = np.zeros(7)
-        pc_rbscatters = np.zeros(7)
-        rbscatters = np.zeros(7)
-        scatters = np.zeros(7)
+        data = load_obs_data('redshifts/z%03d_data.npz' % int(100*z))
+
+        mult = np.array([radii_definitions[k][1] for k in range(6, 13)])
         msk = data[0, :, 9] > 1e14
-        for k in range(6, 13):
-            mult[k-6] = radii_definitions[k][1]
-            slopes[k-6], norms[k-6], pc_scatters[k-6], pc_rbscatters[k-6], scatters[k-6], rbscatters[k-6] = compute_fit(
-                data[0, msk, k], data[3, msk, k], zero_point=10**14 / ((1+z)**(3./2.))**scaling_factors[2])
-        scat_interp = interp(mult, pc_rbscatters)
-        slope_interp = interp(mult, slopes)
-        norm_interp = interp(mult, norms)
+        slopes, norms, pc_scatters, pc_rbscatters, scatters, rbscatters = compute_fits(
+            data[:, :, 6:13], msk, zero_point=10**14 / ((1+z)**(3./2.))**scaling_factors[2])
+        scat_interp = interp(mult, pc_rbscatters[3])
+        slope_interp = interp(mult, slopes[3])
+        norm_interp = interp(mult, norms[3])
         mult_arr = np.linspace(0.3, 2.0, 60)
         ax[0].plot(mult_arr, scat_interp(mult_arr),
                    color=cols[::-1][i], label=r'$%.0f$' % z)
@@ -1454,28 +1615,21 @@ def plot_3x3_means_varyM_masscuts():
     # loop over cosmology
     cosmo = cosmology.setCosmology('planck18')
     # load in the data
-    data = np.load(obs_data_dir / ('planck18_data.npz'))['data']
+    data = load_obs_data('planck18_data.npz')
 
     msks = [data[0, :, 9] >= 1e12, data[0, :, 9] >= 1e13,
             data[0, :, 9] >= 10**13.5, data[0, :, 9] >= 2e14]
     msk_labels = [r'$12.0$', r'$13.0$', r'$13.5$', r'$14.0$']
     cols = sns.cubehelix_palette(len(msks))
 
-    mult = np.zeros(7)
-    slopes = np.zeros(7)
-    norms = np.zeros(7)
-    pc_scatters = np.zeros(7)
-    pc_rbscatters = np.zeros(7)
-    rbscatters = np.zeros(7)
-    scatters = np.zeros(7)
+    # all mass cuts in one fit
+    mult = np.array([radii_definitions[k][1] for k in range(6, 13)])
+    slopes, norms, pc_scatters, pc_rbscatters, scatters, rbscatters = compute_fits(
+        data[:, :, 6:13], msks, zero_point=10**14)
     for i, msk in enumerate(msks):
-        for k in range(6, 13):
-            mult[k-6] = radii_definitions[k][1]
-            slopes[k-6], norms[k-6], pc_scatters[k-6], pc_rbscatters[k-6], scatters[k-6], rbscatters[k-6] = compute_fit(
-                data[0, msk, k], data[3, msk, k], zero_point=10**14)
-        scat_interp = interp(mult, pc_rbscatters)
-        slope_interp = interp(mult, slopes)
-        norm_interp = interp(mult, norms)
+        scat_interp = interp(mult, pc_rbscatters[i, 3])
+        slope_interp = interp(mult, slopes[i, 3])
+        norm_interp = interp(mult, norms[i, 3])
         mult_arr = np.linspace(0.3, 2.0, 60)
         ax[0].plot(mult_arr, scat_interp(mult_arr),
                    color=cols[i], label=msk_labels[i])
@@ -1514,30 +1668,28 @@ plot_3x3_means_varyM_masscuts()
 
 def multimah_multiM(z_obs, cosmo, Nmah):
     # loads in an array of MAH from Frank's MAH code, specify Nmah = number of MAH to get
-    z_int = int(100*z_obs)
+    # along with the t04 snapshot index and concentration of every halo at every snapshot
+    # each z_obs has its own MAHs: the z%03d_data.npz saved from an earlier run, or MAH files in mah_data/z%03d
     mah_dir = obs_data_dir / 'redshifts/mah_data'
     fn = mah_dir / ('z%03d_data.npz' % int(100*z_obs))
     if(isfile(fn)):
-        d = np.load(fn)
-        return d['dat'], d['redshifts'], d['lbtime'], d['masses']
+        store = open_npz_store(fn, Nmah)
+    elif(isdir(mah_dir / ('z%03d' % int(100*z_obs)))):
+        store = open_mah_store(mah_dir / ('z%03d' % int(100*z_obs)), Nmah)
     else:
-        masses = 10**np.loadtxt(mah_dir / 'halomasses.dat')[:Nmah]
-        dat1 = np.loadtxt(mah_dir / 'MAH0001.dat')
-        redshifts = dat1[:, 1]
-        lbtime = dat1[:, 2]
-        nz = len(dat1)
-        dat = np.zeros((Nmah, nz))
-        std = np.zeros((nz, 2))
-        for i in range(0, Nmah):
-            dat[i, :] = 10**np.loadtxt(mah_dir / ('MAH%04d.dat' %
-                                                  (i+1)), usecols=3) * masses[i]
-        np.savez(fn, dat=dat, redshifts=redshifts,
-                 lbtime=lbtime, masses=masses)
-        return dat, redshifts, lbtime, masses
+        raise FileNotFoundError('no MAHs for z=%g: need %s or MAH files in %s' % (z_obs, fn, mah_dir / ('z%03d' % int(100*z_obs))))
+    # only t04 is saved with the store; the concentrations also depend on the cosmology, so they are recomputed
+    if('t04_inds' not in store):
+        save_derived(store, t04_inds=t04_table(store['mah']))
+    masses = np.array(store['masses'][:Nmah])
+    dat = store['mah'][:Nmah] * masses[:, None]
+    lbtime = np.array(store['lbtime'])
+    t04_inds = np.array(store['t04_inds'][:Nmah])
+    return dat, np.array(store['redshifts']), lbtime, masses, t04_inds, conc_table(t04_inds, lbtime, cosmo.age(0), zhao_vdb_conc)
 
 
 cosmo = cosmology.setCosmology('planck18')
-mah, zeds, lbtimes, mvirs = multimah_multiM(0.0, cosmo, 9999)
+mah, zeds, lbtimes, mvirs, t04s, concs = multimah_multiM(0.0, cosmo, 9999)
 
 # using this, we will be able to compute MARs according to some definition
 
@@ -1551,9 +1703,11 @@ mah, zeds, lbtimes, mvirs = multimah_multiM(0.0, cosmo, 9999)
 cosmo = cosmology.setCosmology('planck18')
 
 
-def MAR(mah, zeds, lbtimes, zf=0., zi=0.5):
+def MAR(mah, zeds, lbtimes, zf=0., zi=0.5, concs=None):
     # delta log(Mvir) / delta log(a)
     # find the index corresponding to z=0.5
+    # concs is the (halo, snapshot) concentration table from multimah_multiM, otherwise
+    # the t04 indices are looked up for just the two snapshots needed
 
     zf_ind = np.where(zeds >= zf)[0][0]
     zi_ind = np.where(zeds >= zi)[0][0]
@@ -1567,18 +1721,16 @@ def MAR(mah, zeds, lbtimes, zf=0., zi=0.5):
     mvirs_zf = mah[:, zf_ind]
     mvirs_zi = mah[:, zi_ind]
 
-    concs_zf = np.zeros(len(mah))
-    concs_zi = np.zeros(len(mah))
-
     delta_log_a = -1.*np.log10(1. + zf) - (-1.*np.log10(1. + zi))
 
-    for i in range(0, len(mah)):
-        t04_ind_zf = np.where(mah[i, :] > 0.04 * mvirs_zf[i])[0][-1]
-        t04_ind_zi = np.where(mah[i, :] > 0.04 * mvirs_zi[i])[0][-1]
-        t04_zf = t0 - lbtimes[t04_ind_zf]
-        t04_zi = t0 - lbtimes[t04_ind_zi]
-        concs_zf[i] = zhao_vdb_conc(tf, t04_zf)
-        concs_zi[i] = zhao_vdb_conc(ti, t04_zi)
+    if(concs is None):
+        t04_inds = last_index_above(
+            mah, 0.04 * np.column_stack((mvirs_zf, mvirs_zi)))
+        concs_zf = zhao_vdb_conc(tf, t0 - lbtimes[t04_inds[:, 0]])
+        concs_zi = zhao_vdb_conc(ti, t0 - lbtimes[t04_inds[:, 1]])
+    else:
+        concs_zf = concs[:, zf_ind]
+        concs_zi = concs[:, zi_ind]
 
     # compute the M200ms for each mass at zf, zi
     m200m_zf, _, _ = mass_defs.changeMassDefinition(
@@ -1590,7 +1742,7 @@ def MAR(mah, zeds, lbtimes, zf=0., zi=0.5):
     return mar
 
 
-mars = MAR(mah, zeds, lbtimes)
+mars = MAR(mah, zeds, lbtimes, concs=concs)
 
 
 # In[70]:
@@ -1632,8 +1784,6 @@ def MAR_interp(mah, zeds, lbtimes, zf=0., zi=0.5):
 
     mvirs_zf = np.zeros(len(mah))
     mvirs_zi = np.zeros(len(mah))
-    concs_zf = np.zeros(len(mah))
-    concs_zi = np.zeros(len(mah))
 
     for i in range(0, len(mah)):
         mass_interp = interp(zeds, mah[i, :], k=1)
@@ -1652,13 +1802,11 @@ def MAR_interp(mah, zeds, lbtimes, zf=0., zi=0.5):
 
     delta_log_a = -1.*np.log10(1. + zf) - (-1.*np.log10(1. + zi))
 
-    for i in range(0, len(mah)):
-        t04_ind_zf = np.where(mah[i, :] > 0.04 * mvirs_zf[i])[0][-1]
-        t04_ind_zi = np.where(mah[i, :] > 0.04 * mvirs_zi[i])[0][-1]
-        t04_zf = t0 - lbtimes[t04_ind_zf]
-        t04_zi = t0 - lbtimes[t04_ind_zi]
-        concs_zf[i] = zhao_vdb_conc(tf, t04_zf)
-        concs_zi[i] = zhao_vdb_conc(ti, t04_zi)
+    # the interpolated masses aren't on the snapshots, so these t04s can't come from the table
+    t04_inds = last_index_above(
+        mah, 0.04 * np.column_stack((mvirs_zf, mvirs_zi)))
+    concs_zf = zhao_vdb_conc(tf, t0 - lbtimes[t04_inds[:, 0]])
+    concs_zi = zhao_vdb_conc(ti, t0 - lbtimes[t04_inds[:, 1]])
 
     # compute the M200ms for each mass at zf, zi
     m200m_zf, _, _ = mass_defs.changeMassDefinition(
@@ -1697,7 +1845,7 @@ print(z_dyn)
 # Comparison of interpolator case vs. discrete, showing insignificant difference
 
 planckdata = np.load(obs_data_dir / 'planck18_data.npz')['data']
-mars = MAR(mah, zeds, lbtimes, zf=0., zi=z_dyn)
+mars = MAR(mah, zeds, lbtimes, zf=0., zi=z_dyn, concs=concs)
 mars_interp = MAR_interp(mah, zeds, lbtimes, zf=0., zi=z_dyn)
 
 msk = planckdata[0, :, 9] >= 1e14
@@ -1717,7 +1865,7 @@ plt.ylabel(r'pdf')
 # compare MARs to YSZ residuals
 
 planckdata = np.load(obs_data_dir / 'planck18_data.npz')['data']
-mars = MAR(mah, zeds, lbtimes, zf=0., zi=z_dyn)
+mars = MAR(mah, zeds, lbtimes, zf=0., zi=z_dyn, concs=concs)
 
 msk = planckdata[0, :, 9] >= 1e14
 
@@ -1789,14 +1937,14 @@ all_mars = []
 rad_ind = 9 #R200m
 for i,zobs in enumerate(zzs):
     planckdata = np.load(obs_data_dir / ('redshifts/z%03d_data.npz' % int(100*zobs)))['data']
-    mah, zeds, lbtimes, mvirs = multimah_multiM(zobs, cosmo, 9999)
+    mah, zeds, lbtimes, mvirs, t04s, concs = multimah_multiM(zobs, cosmo, 9999)
     mtest = 10**15
     r200m = mass_so.M_to_R(mtest, zobs, '200m') # in kpc/h
     tdyn_diemer = 2. * (r200m**3 / (G*mtest))**(1./2.) * km_per_kpc / (cosmology.getCurrent().H0 / 100.) / s_per_Gyr
     prop_time = cosmo.age(zobs) - tdyn_diemer # This is the proper time corresponding to where we want to look back
     zdyn_from_zobs = cosmo.age(prop_time, inverse=True)
     
-    mars = MAR(mah, zeds, lbtimes, zf = zobs, zi=zdyn_from_zobs)
+    mars = MAR(mah, zeds, lbtimes, zf = zobs, zi=zdyn_from_zobs, concs=concs)
     
     msk = planckdata[0,:,9]>=1e14
     mah = mah[msk]
@@ -1856,6 +2004,49 @@ fig.text(0.08, 0.5, r'$\Gamma - \Gamma^*$', va='center', rotation='vertical', fo
 #plt.savefig(fig_dir / 'resids_vs_mar.pdf', bbox_inches='tight', dpi=300)
 
 
+# In[ ]:
+
+
+# Same correlation, but with Gamma over many windows (zobs, zi) going back a multiple of tdyn,
+# all windows of one zobs computed in a single mar_windows call. The Mvir at the window edges
+# are interpolated in log M rather than taken at the nearest snapshot as in MAR
+
+tdyn_mults = np.linspace(0.25, 2., 15)
+rad_ind = 9 #R200m
+
+fig, ax = plt.subplots(nrows=1, ncols=2, figsize=(13,5), sharex=True, sharey=True, gridspec_kw={'wspace':0.02})
+for i,zobs in enumerate(zzs):
+    planckdata = np.load(obs_data_dir / ('redshifts/z%03d_data.npz' % int(100*zobs)))['data']
+    mah, zeds, lbtimes, mvirs, t04s, concs = multimah_multiM(zobs, cosmo, 9999)
+    mtest = 10**15
+    r200m = mass_so.M_to_R(mtest, zobs, '200m') # in kpc/h
+    tdyn_diemer = 2. * (r200m**3 / (G*mtest))**(1./2.) * km_per_kpc / (cosmology.getCurrent().H0 / 100.) / s_per_Gyr
+    zis = cosmo.age(cosmo.age(zobs) - tdyn_mults * tdyn_diemer, inverse=True)
+    windows = np.column_stack((np.full(len(zis), zobs), zis))
+    mars = mar_windows(mah, zeds, lbtimes, cosmo.age(0), windows, zhao_vdb_conc)
+
+    msk = planckdata[0,:,9]>=1e14
+    mars = mars[msk]
+    coeffs = np.polyfit(np.log10(planckdata[0,msk,rad_ind]), np.log10(planckdata[3,msk,rad_ind]), deg=1) # Y_SZ - M reln
+    preds = 10**(coeffs[0]*np.log10(planckdata[0,msk,rad_ind]) + coeffs[1]) # Y_SZ predictions
+    resids = np.log(planckdata[3,msk,rad_ind] / preds)
+
+    rs = [spearmanr(resids, mars[:,j])[0] for j in range(0, len(zis))]
+    rhos = [np.corrcoef(resids, mars[:,j])[1,0] for j in range(0, len(zis))]
+    print(zobs, np.round(rs, 2))
+    ax[0].plot(tdyn_mults, rs, label=r'$z=%.0f$' % zobs)
+    ax[1].plot(tdyn_mults, rhos)
+
+ax[0].set_ylabel(r'correlation of $\mathcal{R}$ with $\Gamma$')
+ax[0].set_title(r'$r_s$')
+ax[1].set_title(r'$\rho$')
+for i in range(0,2):
+    ax[i].set_xlabel(r'window length $[t_\mathrm{dyn}]$')
+    ax[i].yaxis.set_ticks_position('both')
+    ax[i].xaxis.set_ticks_position('both')
+ax[0].legend(frameon=False)
+
+
 # In[78]:
 
 
@@ -1875,14 +2066,14 @@ def plot_covar():
 
     cosmo = cosmology.setCosmology('planck18')
     planckdata = np.load(obs_data_dir/'redshifts/z000_data.npz')['data']
-    mah, zeds, lbtimes, mvirs = multimah_multiM(zobs, cosmo, 9999)
+    mah, zeds, lbtimes, mvirs, t04s, concs = multimah_multiM(zobs, cosmo, 9999)
     mtest = 10**15
     r200m = mass_so.M_to_R(mtest, zobs, '200m')  # in kpc/h
     tdyn_diemer = 2. * (r200m**3 / (G*mtest))**(1./2.) *         km_per_kpc / (cosmology.getCurrent().H0 / 100.) / s_per_Gyr
     # This is the proper time corresponding to where we want to look back
     prop_time = cosmo.age(zobs) - tdyn_diemer
     zdyn_from_zobs = cosmo.age(prop_time, inverse=True)
-    mars = MAR(mah, zeds, lbtimes, zf=zobs, zi=zdyn_from_zobs)
+    mars = MAR(mah, zeds, lbtimes, zf=zobs, zi=zdyn_from_zobs, concs=concs)
 
     msk = planckdata[0, :, 9] >= 1e14
     mah = mah[msk]
@@ -0,0 +1,61 @@
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+# tabulated f_nth(r/r200m, nu_200m, z) for one cosmology, built once from the full model in the analysis notebook
+# (gen_fnth) and then interpolated, in place of refitting fnth_fit with curve_fit for every cosmology.
+# The table is on a regular grid in (ln(r/r200m), nu_200m, z) and is interpolated linearly; the error bounds
+# stored with it are measured against the full model, see build_emulator
+
+
+def build_emulator(fnth_of, x, nu, z, **meta):
+    '''
+    Tabulate fnth_of(nu, z, x), the f_nth profile at radii x = r/r200m of the halo with peak height
+    nu_200m at redshift z, on the grid x (nx,), nu (nnu,), z (nz,); meta (cosmology, beta, eta, ...)
+    is stored alongside. Error bounds:
+      err_nu (nz,): max |emulator - model| at the nu midpoints of the grid, from extra model runs
+      err_z  (nz,): max |linear interpolation between z[k-1] and z[k+1] - model at z[k]|, a
+                    conservative bound on the error between z nodes (twice the real spacing), 0 at the ends
+    Returns a dict that can be saved with save_emulator and evaluated with emulate.
+    '''
+    x, nu, z = np.asarray(x, dtype=float), np.asarray(nu, dtype=float), np.asarray(z, dtype=float)
+    table = np.array([[fnth_of(n, zz, x) for zz in z] for n in nu]) # (nnu, nz, nx)
+    emu = dict(meta, lnx=np.log(x), nu=nu, z=z, table=np.transpose(table, (2, 0, 1)))
+
+    nu_mid = 0.5 * (nu[1:] + nu[:-1])
+    err_nu = np.zeros(len(z))
+    for k, zz in enumerate(z):
+        for n in nu_mid:
+            pred = emulate(emu, x, n, zz)
+            err_nu[k] = max(err_nu[k], np.max(np.abs(pred - fnth_of(n, zz, x))))
+    err_z = np.zeros(len(z))
+    for k in range(1, len(z) - 1):
+        w = (z[k] - z[k-1]) / (z[k+1] - z[k-1])
+        pred = (1. - w) * table[:, k-1] + w * table[:, k+1]
+        err_z[k] = np.max(np.abs(pred - table[:, k]))
+    emu['err_nu'] = err_nu
+    emu['err_z'] = err_z
+    return emu
+
+
+def emulate(emu, x, nu, z):
+    # f_nth at r/r200m = x, nu_200m = nu and redshift z; the three broadcast against each other,
+    # and points outside the tabulated range raise a ValueError
+    lnx, nu, z = np.broadcast_arrays(np.log(x), nu, z)
+    if('_interp' not in emu):
+        emu['_interp'] = RegularGridInterpolator((emu['lnx'], emu['nu'], emu['z']), emu['table'])
+    return emu['_interp'](np.stack((lnx.ravel(), nu.ravel(), z.ravel()), axis=-1)).reshape(lnx.shape)
+
+
+def error_bound(emu, z):
+    # max absolute f_nth error of the emulator at redshift z, from the bounds stored at the neighbouring z nodes
+    k = np.clip(np.searchsorted(emu['z'], z), 1, len(emu['z']) - 1)
+    return np.maximum(np.maximum(emu['err_nu'][k-1], emu['err_nu'][k]), np.maximum(emu['err_z'][k-1], emu['err_z'][k]))
+
+
+def save_emulator(fn, emu):
+    np.savez(fn, **{key: val for key, val in emu.items() if not key.startswith('_')})
+
+
+def load_emulator(fn):
+    with np.load(fn) as d:
+        return {key: d[key] for key in d.files}
@@ -1,4 +1,6 @@
-import sys
+import os
+import time
+import argparse
 import numpy as np
 import colossus
 from colossus.cosmology import cosmology
@@ -7,7 +9,12 @@ from pathlib import Path
 from os.path import expanduser
 from scipy.integrate import quad
 from scipy.interpolate import InterpolatedUnivariateSpline as interp
-from os.path import isfile
+from multiprocessing import get_context
+from multiprocessing.sharedctypes import RawArray
+from mah_utils import t04_table, conc_table, open_mah_store, save_derived
+from nth_kernels import integrate_sig2nth, thinning_error, limit_threads, t_bv
+from run_cache import cache_key, cache_lookup, cache_store, cosmology_params
+from ks_profile import ks_norm_integral
 
 print("Finished imports", flush=True)
 
@@ -35,6 +42,16 @@ eta_def  = 0.7
 Nmah = 9999
 Nradii = 500
 N_r200m_mult = 2
+Nbatch = 256 # haloes per block in gen_obs; None to integrate one halo at a time
+projection_mode = 'discrete' # 'discrete' reproduces p_2_y, 'shell' integrates each shell analytically
+aperture_rtol = 1e-8 # relative accuracy of the cumulative aperture integrals
+validate_nfw = False # check the analytic NFW enclosed masses against quad
+validate_ks = False # check the tabulated KS gas normalization against quad
+nth_kernel = True # integrate sig2nth with the compiled kernel in nth_kernels.py instead of evolve_halo(s)
+nth_scheme = 'euler' # kernel only: 'exp' takes the -sig2nth/t_d decay exactly instead of forward Euler
+snapshot_thin = 1 # kernel only: step over every snapshot_thin-th MAH snapshot
+nth_timescale = 'td' # dissipation timescale: 'td', or 'tBV' for the Brunt-Vaisala one (numpy path, evolve_halos)
+Nthin_check = 64 # haloes used to estimate the f_nth error of snapshot_thin against the run on every snapshot
 # NOTE: We use zi=30., which works to be the equivalent of starting
 # at the redshift where the halo mass reaches psi_res=10^-4
 zi=30.
@@ -75,10 +92,7 @@ cosmology.addCosmology('planck18_lH', fiducial_params)
 fiducial_params = cosmology.cosmologies['planck18'].copy()
 fiducial_params['H0'] = 75
 cosmology.addCosmology('planck18_hH', fiducial_params)
-
-cname = sys.argv[1] # load in cosmology name from the ones above
-cosmo = cosmology.setCosmology(cname)
-cbf = cosmo.Ob0 / cosmo.Om0
+paper_cosmologies = ['planck18'] + [name for name in cosmology.cosmologies if name.startswith('planck18_')]
 
 radii_definitions = [('vir', 1), ('500c', 1), ('500c', 2), ('500c', 3), ('500c', 4), ('500c', 5),
                      ('200m', 0.3), ('200m', 0.5), ('200m', 0.875), ('200m', 1.0), ('200m', 1.25),
@@ -99,9 +113,28 @@ def NFWf(x):
 def NFWM(r, M, z, c, R):
     return M * NFWf(c*r/R) / NFWf(c)
 
-def t_d(r, M, z, c, R, beta=beta_def):
+def nfw_enclosed_mass(r, rhos=None, rs=None, M=None, c=None, R=None, validate=None):
+    # NFW mass inside r, from (rhos, rs) or from (M, c, R) with R the radius that encloses M
+    # everything broadcasts, e.g. (Nhalo, 1) parameters against (Nhalo, Naperture) radii
+    # validate=True checks every element against the quad of nfw_prof that this replaces; None uses validate_nfw
+    if(validate is None):
+        validate = validate_nfw
+    if(rhos is None):
+        rs = R / c
+        rhos = M / (4. * np.pi * rs**3 * NFWf(c))
+    Menc = 4. * np.pi * rhos * rs**3 * NFWf(r / rs)
+    if(validate):
+        for Mi, ri, rhosi, rsi in np.nditer(np.broadcast_arrays(Menc, r, rhos, rs)):
+            Mq = quad(lambda x: 4. * np.pi * x**2 * nfw_prof(x, rhosi, rsi), 0, ri)[0]
+            assert np.isclose(Mi, Mq, rtol=1e-6, atol=0), 'NFW M(<%g) = %g, quad gives %g' % (ri, Mi, Mq)
+    return Menc
+
+def t_d(r, M, z, c, R, beta=beta_def, h=None):
+    # h can be passed in to skip looking up the current cosmology
+    if(h is None):
+        h = cosmology.getCurrent().H0 / 100.
     Menc = NFWM(r, M, z, c, R)
-    t_dyn = 2. * np.pi * (r**3 / (G*Menc))**(1./2.) * km_per_kpc / (cosmology.getCurrent().H0 / 100.)
+    t_dyn = 2. * np.pi * (r**3 / (G*Menc))**(1./2.) * km_per_kpc / h
     return beta * t_dyn / s_per_Gyr / 2.
 
 def Gamma(c_nfw):
@@ -110,25 +143,32 @@ def Gamma(c_nfw):
 def eta0(c_nfw):
     return 0.00676*(c_nfw - 6.5)**2 + 0.206*(c_nfw - 6.5) + 2.48
 
-def multimah_multiM(z_obs, cosmo, Nmah):
+def multimah_multiM(z_obs, cosmo, Nmah, workers=None):
     # loads in an array of MAH from Frank's MAH code, specify Nmah = number of MAH to get
+    # along with the t04 snapshot index and concentration of every halo at every snapshot
+    # the MAH files are parsed once into a memory-mapped store that is rebuilt when they change
     mah_dir = multimah_root / ('%s' % (cosmo.name))
-    fn = mah_dir / 'mah_data.npz'
-    if(isfile(fn)):
-        d = np.load(fn)
-        return d['dat'], d['redshifts'], d['lbtime'], d['masses']
-    else:
-        masses = 10**np.loadtxt(mah_dir / 'halomasses.dat')[:Nmah]
-        dat1 = np.loadtxt(mah_dir / 'MAH0001.dat')
-        redshifts = dat1[:,1]
-        lbtime = dat1[:,2]
-        nz = len(dat1)
-        dat = np.zeros((Nmah, nz))
-        std = np.zeros((nz,2))
-        for i in range(0,Nmah):
-            dat[i,:] = 10**np.loadtxt(mah_dir / ('MAH%04d.dat' %(i+1)), usecols=3) * masses[i]
-        np.savez(fn, dat=dat, redshifts=redshifts, lbtime=lbtime, masses=masses)
-        return dat, redshifts, lbtime, masses
+    store = open_mah_store(mah_dir, Nmah, workers=workers)
+    # only t04 depends on the MAHs alone; the concentrations depend on conc_model and cosmo.age(0) as well,
+    # so they are recomputed on every call rather than saved with the store
+    if('t04_inds' not in store):
+        save_derived(store, t04_inds=t04_table(store['mah']))
+    masses = np.array(store['masses'][:Nmah])
+    dat = store['mah'][:Nmah] * masses[:,None]
+    lbtime = np.array(store['lbtime'])
+    t04_inds = np.array(store['t04_inds'][:Nmah])
+    return dat, np.array(store['redshifts']), lbtime, masses, t04_inds, conc_table(t04_inds, lbtime, cosmo.age(0), conc_model)
+
+def snapshot_cosmology(redshifts):
+    # the part of R_vir that only depends on cosmology, once for all snapshots
+    # rho_vir(z) = Delta_vir(z) rho_c(z), i.e. mass_so.densityThreshold(z, 'vir')
+    cosmo = cosmology.getCurrent()
+    delta_vir = mass_so.deltaVir(redshifts)
+    return delta_vir * cosmo.rho_c(redshifts)
+
+def M_to_Rvir(M, rho_vir):
+    # mass_so.M_to_R(M, z, 'vir') with the threshold density precomputed; M can be (Nmah, nz) against rho_vir (nz,)
+    return (M * 3.0 / 4.0 / np.pi / rho_vir)**(1.0 / 3.0)
 
 def sig2_tot(r, M, c, R):
     rho0_by_P0 = 3*eta0(c)**-1 * R/(G*M)
@@ -150,6 +190,38 @@ def p_2_y(r,p):
         yv[i] = np.sum(p[i+1:]*r[i+1:]**2*dlogr/np.sqrt(r[i+1:]**2-r[i]**2))
     return 2.0 * sigmaT_by_mec2 * yv # this is in units of h
 
+# projection operators already built for a given radial grid and mode
+_projection_ops = {}
+
+def projection_operator(rads, mode=None):
+    '''
+    Matrix A with y = 2 sigmaT/mec2 * R * (A @ P) for pressures P at radii r = R*rads,
+    so that the LOS integral in p_2_y becomes one matrix product for a whole block of haloes.
+    rads must be equal log space; the result has len(rads)-1 rows, like p_2_y.
+    mode='discrete' is exactly the p_2_y sum, which skips the singular shell j=i.
+    mode='shell' takes P constant across each log shell and integrates the chord through it
+    analytically, so the shell straddling r2d=r3d contributes its finite share.
+    mode=None uses projection_mode as it is at the time of the call.
+    '''
+    if(mode is None):
+        mode = projection_mode
+    key = (len(rads), rads[0], rads[-1], mode)
+    if(key not in _projection_ops):
+        dlogr = np.log(rads[2]/rads[1])
+        r2d = rads[:-1,None]
+        r3d = rads[None,:]
+        if(mode == 'discrete'):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                A = np.where(r3d > r2d, r3d**2 * dlogr / np.sqrt(r3d**2 - r2d**2), 0.)
+        elif(mode == 'shell'):
+            lo = np.maximum(r3d * np.exp(-0.5*dlogr), r2d)
+            hi = np.maximum(r3d * np.exp(0.5*dlogr), r2d)
+            A = np.sqrt(hi**2 - r2d**2) - np.sqrt(lo**2 - r2d**2)
+        else:
+            raise ValueError('Unknown projection mode %s' % mode)
+        _projection_ops[key] = A
+    return _projection_ops[key]
+
 # This outputs in units of kpc^2 / h, standard unit is Mpc^2, verified magnitudes
 def YSZ(yprof, rads, Rx):
     # interpolate the yprof
@@ -162,132 +234,463 @@ def YSZr(pressure_interp, Rx):
     Y = (4.0 * np.pi / 3.0) * quad(lambda x: pressure_interp(x) * x**2., 0, Rx)[0]
     return Y * sigmaT_by_mec2
 
-def gen_obs(cosmo, beta=beta_def, eta=eta_def):
-
-    mah, redshifts, lbtime, masses = multimah_multiM(zobs, cosmo, Nmah)
-    print("Loaded MAH", flush=True)
+def ks_theta(r, c, R):
+    # Komatsu & Seljak polytropic variable; c and R may be column vectors to broadcast over haloes
+    phi0 = -1. * (c / NFWf(c))
+    phir = -1. * (c / NFWf(c)) * (np.log(1. + c*r/R) / (c*r/R))
+    return 1. + ((Gamma(c) - 1.) / Gamma(c)) * 3. *eta0(c)**-1 * (phi0 - phir)
+
+def record_history(history, snap, sig2nth, sig2tot, ds2dt):
+    # diagnostics for evolve_halo(s): append the state at snapshot snap
+    history['snaps'].append(snap)
+    history['sig2nth'].append(sig2nth.copy())
+    history['sig2tot'].append(sig2tot.copy())
+    history['ds2dt'].append(ds2dt.copy())
+
+def stack_history(history):
+    return {key: np.array(val) for key, val in history.items()}
+
+def evolve_halo(mah, concs, rvirs, redshifts, lbtime, zi_snap, rds, h, beta=beta_def, eta=eta_def, record=None, timescale='td'):
+    # integrate sig2nth for a single halo from zi_snap down to z=0, returns the z=0 profiles
+    # mah, concs and rvirs are the halo's rows of the MAH, concentration and R_vir tables
+    # only the current and previous snapshot are kept, so memory does not grow with the number of snapshots
+    # record: optional snapshot indices (< zi_snap) at which to keep sig2nth, sig2tot and ds2dt;
+    # if given, a dict of those (n_record, Nradii) histories is returned as well. This is only for calling
+    # evolve_halo(s) by hand: gen_obs never records, and the nth_kernels path has no recording at all
+    # timescale='tBV' uses the Brunt-Vaisala timescale of the previous step's f_nth profile instead of t_d,
+    # with no dissipation at radii where that profile is convectively unstable (see t_bv)
+    history = {'snaps': [], 'sig2nth': [], 'sig2tot': [], 'ds2dt': []}
+    record = set() if record is None else set(record)
+    sig2tot_1 = sig2_tot(rds, mah[zi_snap], concs[zi_snap], rvirs[zi_snap]) # this function takes radii in physical kpc/h
+    for i in range(zi_snap,0,-1):
+        z_2 = redshifts[i-1] #second redshift, the one we are actually at
+        dt = lbtime[i] - lbtime[i-1] # in Gyr
+        mass_2 = mah[i-1]
+        Rvir_2 = rvirs[i-1]
+
+        # concentrations from the t04 table made with the MAH
+        c_2 = concs[i-1]
+        sig2tot_2 = sig2_tot(rds, mass_2, c_2, Rvir_2)
+        ds2dt = (sig2tot_2 - sig2tot_1) / dt # see if this works better, full change
+        if(i==zi_snap):
+            sig2nth = eta * sig2tot_2 # starts at z_i = 6 roughly
+        else:
+            if(timescale == 'td'):
+                td = t_d(rds, mass_2, z_2, c_2, Rvir_2, beta=beta, h=h) #t_d at z of interest z_2
+            elif(timescale == 'tBV'):
+                td = t_bv(rds, mass_2, c_2, Rvir_2, sig2nth / sig2tot_1, beta, h)
+            else:
+                raise ValueError('Unknown dissipation timescale %s' % timescale)
+            sig2nth = sig2nth + ((-1. * sig2nth / td) + eta * ds2dt)*dt
+            sig2nth[sig2nth < 0] = 0 #can't have negative sigma^2_nth at any point in time
+        if(i-1 in record):
+            record_history(history, i-1, sig2nth, sig2tot_2, ds2dt)
+        sig2tot_1 = sig2tot_2
+    if(record):
+        return sig2nth, sig2tot_2, c_2, Rvir_2, stack_history(history)
+    return sig2nth, sig2tot_2, c_2, Rvir_2
+
+def evolve_halos(mah, concs, rvirs, redshifts, lbtime, zi_snap, rds, h, beta=beta_def, eta=eta_def, record=None, timescale='td'):
+    # same as evolve_halo, but for a block of haloes at once; the tables have a row per halo and rds is (halos, Nradii)
+    # every per-halo scalar becomes a column vector so the snapshot loop runs on (halos x Nradii) arrays
+    history = {'snaps': [], 'sig2nth': [], 'sig2tot': [], 'ds2dt': []}
+    record = set() if record is None else set(record)
+    sig2tot_1 = sig2_tot(rds, mah[:, zi_snap, None], concs[:, zi_snap, None], rvirs[:, zi_snap, None])
+    for i in range(zi_snap,0,-1):
+        z_2 = redshifts[i-1]
+        dt = lbtime[i] - lbtime[i-1] # in Gyr
+        mass_2 = mah[:, i-1]
+        Rvir_2 = rvirs[:, i-1]
+
+        c_2 = concs[:, i-1]
+        sig2tot_2 = sig2_tot(rds, mass_2[:,None], c_2[:,None], Rvir_2[:,None])
+        ds2dt = (sig2tot_2 - sig2tot_1) / dt
+        if(i==zi_snap):
+            sig2nth = eta * sig2tot_2
+        else:
+            if(timescale == 'td'):
+                td = t_d(rds, mass_2[:,None], z_2, c_2[:,None], Rvir_2[:,None], beta=beta, h=h)
+            elif(timescale == 'tBV'):
+                td = t_bv(rds, mass_2[:,None], c_2[:,None], Rvir_2[:,None], sig2nth / sig2tot_1, beta, h)
+            else:
+                raise ValueError('Unknown dissipation timescale %s' % timescale)
+            sig2nth = sig2nth + ((-1. * sig2nth / td) + eta * ds2dt)*dt
+            sig2nth[sig2nth < 0] = 0
+        if(i-1 in record):
+            record_history(history, i-1, sig2nth, sig2tot_2, ds2dt)
+        sig2tot_1 = sig2tot_2
+    if(record):
+        return sig2nth, sig2tot_2, c_2, Rvir_2, stack_history(history)
+    return sig2nth, sig2tot_2, c_2, Rvir_2
+
+def gas_normalization(mass, cvir, Rvir, R2R200m):
+    # rho0 of the KS gas profile, plus the NFW parameters used for the enclosed masses; all arguments can be arrays over haloes
+    rhos, rs = profile_nfw.NFWProfile.fundamentalParameters(mass, cvir, zobs, 'vir')
+    # need M(<2R200m) for gas mass normalization
+    M2R200m = nfw_enclosed_mass(R2R200m, rhos, rs)
+    cosmo = cosmology.getCurrent()
+    cbf = cosmo.Ob0 / cosmo.Om0
+    rho0_nume = cbf * M2R200m
+    # 4 pi int_0^2R200m theta^(1/(Gamma-1)) r^2 dr from the table over concentration in ks_profile.py
+    rho0_denom = 4. * np.pi * Rvir**3 * ks_norm_integral(cvir, R2R200m / Rvir)
+    if(validate_ks):
+        for ci, Ri, R2i, denom in np.nditer(np.broadcast_arrays(cvir, Rvir, R2R200m, rho0_denom)):
+            dq = 4. * np.pi * quad(lambda x: ks_theta(x, ci, Ri)**(1.0 / (Gamma(ci) - 1.0)) * x**2, 0, R2i)[0]
+            assert np.isclose(denom, dq, rtol=1e-6, atol=0), 'KS normalization %g, quad gives %g' % (denom, dq)
+    # This now pegs the gas mass to be equal to cosmic baryon fraction at 2R200m
+    # NOTE: Both rho0_nume and rho_denom need to be changed if the radius is changed
+    return rho0_nume / rho0_denom, rhos, rs
+
+def cumulative_integrals(integrands, r_lo, r_hi, rtol=None, n=256):
+    '''
+    Cumulative integrals int_0^r f(x) dx of several integrands on one shared log grid from r_lo to r_hi.
+    Simpson's rule in ln r; the grid is doubled until Simpson on it and on every other node agree to
+    15*rtol, i.e. until the Richardson estimate of the error is below rtol. Below r_lo the integral is
+    a trapezoid from f(0)=0, so r_lo should be small compared to the radii of interest.
+    Returns the grid (every other node of the final grid) and an (len(integrands), len(grid)) array.
+    rtol=None uses aperture_rtol as it is at the time of the call.
+    '''
+    if(rtol is None):
+        rtol = aperture_rtol
+    while True:
+        lnr = np.linspace(np.log(r_lo), np.log(r_hi), n+1)
+        h = lnr[1] - lnr[0]
+        r = np.exp(lnr)
+        g = np.array([f(r) * r for f in integrands]) # integrating in ln r
+        simpson = np.cumsum(h/3. * (g[:,:-1:2] + 4.*g[:,1::2] + g[:,2::2]), axis=1)
+        coarse = np.sum(2.*h/3. * (g[:,:-1:4] + 4.*g[:,2::4] + g[:,4::4]), axis=1)
+        err = np.max(np.abs(simpson[:,-1] - coarse) / np.abs(simpson[:,-1])) / 15.
+        if(err < rtol or n >= 2**16):
+            break
+        n *= 2
+    inner = 0.5 * g[:,:1] # 0.5 * f(r_lo) * r_lo
+    return r[::2], inner + np.concatenate((np.zeros((len(g), 1)), simpson), axis=1)
+
+def aperture_integrals(integrands, apertures, r_lo, rtol=None):
+    # int_0^R f(x) dx for every integrand and every aperture R, read off one set of cumulative integrals
+    r, cumul = cumulative_integrals(integrands, r_lo, np.max(apertures), rtol)
+    return np.array([interp(np.log(r), c, k=3)(np.log(apertures)) for c in cumul])
+
+def aperture_radii(masses, cvirs, radii_defs=radii_definitions):
+    # R_mdef * mult for every halo and every (mdef, mult) tuple, shape (halos, len(radii_defs))
+    # changeMassDefinition takes arrays of (M, c), so each unique mass definition is converted once for all haloes
+    Rmdef = {}
+    for mdef in set(mdef for mdef, mult in radii_defs):
+        Mdf, Rmdef[mdef], _ = mass_defs.changeMassDefinition(masses, c=cvirs, z=zobs, mdef_in='vir', mdef_out=mdef)
+    return np.array([mult * Rmdef[mdef] for mdef, mult in radii_defs]).T
+
+def halo_apertures(cvir, Rvir, rds, rho0, rhos, rs, Tg, Pth, yprof, Rdefs):
+    # integrate the z=0 profiles of one halo out to each of the aperture radii Rdefs
+    rhogas = lambda rad: rho0 * ks_theta(rad, cvir, Rvir)**(1.0 / (Gamma(cvir) - 1.0))
+    Tgf = interp(rds, Tg) # interpolator for Tgas
+    Pth_interp = interp(rds, Pth, k=3)
+    yprof_interp = interp(rds[:-1], yprof, k=3)
+
+    # same integrands as YSZ, YSZr and the M_gas and T_mgas quads, all integrated in one pass
+    YSZv, YSZrv, Mgasv, Tweighted = aperture_integrals([
+        lambda x: 2.0 * np.pi * yprof_interp(x) * x,
+        lambda x: (4.0 * np.pi / 3.0) * sigmaT_by_mec2 * Pth_interp(x) * x**2,
+        lambda x: 4.0 * np.pi * rhogas(x) * x**2,
+        lambda x: 4.0 * np.pi * Tgf(x) * rhogas(x) * x**2], Rdefs, 0.01*rds[0])
+    Tmgasv = Tweighted/Mgasv
+    mass_enc = nfw_enclosed_mass(Rdefs, rhos, rs)
+    return YSZv, YSZrv, Tmgasv, Mgasv, mass_enc
+
+def nth_error_estimate(mcs, mah, concs, redshifts, lbtime, masses, rho_vir, beta=beta_def, eta=eta_def):
+    # max f_nth error at z=0 of the snapshot_thin integration against the one on every snapshot, for the haloes mcs
+    zi_snap = np.where(redshifts <= zi)[0][-1] + 1
+    rvirs = M_to_Rvir(mah[mcs, :zi_snap+1], rho_vir[:zi_snap+1])
+    R200m = aperture_radii(masses[mcs], concs[mcs, 0], [('200m', 1.0)])[:,0]
+    rds = np.logspace(np.log10(0.01),np.log10(N_r200m_mult), Nradii) * R200m[:,None]
+    return thinning_error(mah[mcs, zi_snap::-1], concs[mcs, zi_snap::-1], rvirs[:, ::-1], -np.diff(lbtime[zi_snap::-1]),
+                          rds, cosmology.getCurrent().H0 / 100., beta, eta, nth_scheme, snapshot_thin)
+
+def obs_block(mcs, mah, concs, redshifts, lbtime, masses, rho_vir, beta=beta_def, eta=eta_def, Nbatch=Nbatch, radii_defs=radii_definitions):
+    # observables for the haloes mcs, which are evolved together unless Nbatch is None (numpy path only)
+    # with the kernel, beta and eta can also be equal-length arrays of (beta, eta) pairs: the sig2_tot and t_d histories
+    # and the gas normalizations are shared between them, and rows gets a leading axis over the pairs
     zi_snap = np.where(redshifts <= zi)[0][-1] + 1 #first snap over z=6
-    t0 = cosmo.age(0) # this way we can easily get proper times using the lookback times from Frank's files
+    h = cosmology.getCurrent().H0 / 100.
+    # R_vir of every halo in the block at every snapshot we integrate over
+    rvirs = M_to_Rvir(mah[mcs, :zi_snap+1], rho_vir[:zi_snap+1])
 
-    n_steps = zi_snap
-    
     rads = np.logspace(np.log10(0.01),np.log10(N_r200m_mult), Nradii) # y_SZ goes out to 2x R_200m for LOS integration, close to splashback radius
 
-    ds2dt    = np.zeros((n_steps, Nradii))
-    sig2tots = np.zeros((n_steps, Nradii))
-    sig2nth  = np.zeros((n_steps, Nradii))
-    cvirs    = np.zeros(Nmah)
-    Rvirs    = np.zeros(Nmah)
-    R_2R200ms= np.zeros(Nmah)
-    # The values that we will return and column_stack
-    YSZv     = np.zeros((Nmah, len(radii_definitions)))
-    YSZrv     = np.zeros((Nmah, len(radii_definitions)))
-    Tmgasv   = np.zeros((Nmah, len(radii_definitions)))
-    Mgasv    = np.zeros((Nmah, len(radii_definitions)))
-    mass_enc = np.zeros((Nmah, len(radii_definitions)))
-
-    for mc in range(0,Nmah):
-        if(mc % 100 == 0):
-            print(mc, flush=True)
-        # get cvir so that we can get R500c/R200m
-        t04_ind = np.where(mah[mc,:] > 0.04*masses[mc])[0][-1]
-        cvir = conc_model(t0 - lbtime[0], t0 - lbtime[t04_ind])
-        Mdf, R200m, _ = mass_defs.changeMassDefinition(masses[mc], c=cvir, z=zobs, mdef_in='vir', mdef_out='200m')
-        R_2R200ms[mc] = 2.0*R200m
-        rds  = rads*R200m #convert to physical units; using r200m, this goes out to 2x R200m
-        # doing it this way ensures that we're using the same fractional radii for each cluster
-
-        # integrate time to z=0 in order to get f_nth profile
-        for i in range(zi_snap,0,-1):
-            z_1 = redshifts[i] #first redshift
-            z_2 = redshifts[i-1] #second redshift, the one we are actually at
-            dt = lbtime[i] - lbtime[i-1] # in Gyr
-            mass_1 = mah[mc, i] #dat = np.zeros((Nmah, nz))
-            mass_2 = mah[mc, i-1]
-            dM = mass_2 - mass_1
-            dMdt = dM/dt # since the (i+1)th is computed between i+1 and i
-            Rvir_1 = mass_so.M_to_R(mass_1, z_1, 'vir')
-            Rvir_2 = mass_so.M_to_R(mass_2, z_2, 'vir')
-
-            time_1 = t0 - lbtime[i]
-            time_2 = t0 - lbtime[i-1]
-            m04_1  = 0.04 * mass_1
-            m04_2  = 0.04 * mass_2
-            t04_ind_1 = np.where(mah[mc,:] > m04_1)[0][-1]
-            t04_ind_2 = np.where(mah[mc,:] > m04_2)[0][-1]
-            t04_1 = t0 - lbtime[t04_ind_1]
-            t04_2 = t0 - lbtime[t04_ind_2]
-
-            c_1 = conc_model(time_1, t04_1)
-            c_2 = conc_model(time_2, t04_2)
-            if(i==1): # final
-                cvirs[mc] = c_2
-                assert cvirs[mc] == cvir
-            sig2tots[i-1,:] = sig2_tot(rds, mass_2, c_2, Rvir_2) # this function takes radii in physical kpc/h
-            if(i==zi_snap):
-                ds2dt[i-1,:] = (sig2tots[i-1,:] - sig2_tot(rds, mass_1, c_1, Rvir_1)) / dt # see if this works better, full change
-                sig2nth[i-1,:] = eta * sig2tots[i-1,:] # starts at z_i = 6 roughly
-            else:
-                ds2dt[i-1,:] = (sig2tots[i-1,:] - sig2tots[i,:]) / dt
-                td = t_d(rds, mass_2, z_2, c_2, Rvir_2, beta=beta_def) #t_d at z of interest z_2
-                sig2nth[i-1,:] = sig2nth[i,:] + ((-1. * sig2nth[i,:] / td) + eta * ds2dt[i-1,:])*dt
-                sig2nth[i-1, sig2nth[i-1,:] < 0] = 0 #can't have negative sigma^2_nth at any point in time
-        fnth = sig2nth[0,:] / sig2tots[0,:]
+    # get cvir so that we can get R200m
+    cvir = concs[mcs, 0]
+    R200m = aperture_radii(masses[mcs], cvir, [('200m', 1.0)])[:,0]
+    R_2R200m = 2.0*R200m
+    rds = rads * R200m[:,None] #convert to physical units; using r200m, this goes out to 2x R200m
+    # doing it this way ensures that we're using the same fractional radii for each cluster
+
+    # integrate time to z=0 in order to get f_nth profile
+    if(nth_kernel and nth_timescale == 'td'):
+        # the kernel runs forwards in time, i.e. from zi_snap down to snapshot 0
+        sig2nth_0, sig2tot_0 = integrate_sig2nth(mah[mcs, zi_snap::-1], concs[mcs, zi_snap::-1], rvirs[:, ::-1],
+                                                 -np.diff(lbtime[zi_snap::-1]), rds, h, np.ravel(beta), np.ravel(eta),
+                                                 scheme=nth_scheme, thin=snapshot_thin)
+        sig2nth_0 = sig2nth_0.reshape(np.shape(beta) + rds.shape)
+        c_2, Rvir_2 = concs[mcs, 0], rvirs[:, 0]
+    elif(np.ndim(beta) > 0):
+        raise ValueError('(beta, eta) sweeps need nth_kernel and t_d')
+    elif(Nbatch is None):
+        assert nth_scheme == 'euler' and snapshot_thin == 1
+        sig2nth_0, sig2tot_0, c_2, Rvir_2 = evolve_halo(mah[mcs[0]], concs[mcs[0]], rvirs[0], redshifts, lbtime, zi_snap, rds[0], h, beta, eta,
+                                                        timescale=nth_timescale)
+        sig2nth_0, sig2tot_0 = sig2nth_0[None,:], sig2tot_0[None,:]
+    else:
+        sig2nth_0, sig2tot_0, c_2, Rvir_2 = evolve_halos(mah[mcs], concs[mcs], rvirs, redshifts, lbtime, zi_snap, rds, h, beta, eta,
+                                                         timescale=nth_timescale)
+    assert np.all(c_2 == cvir)
+    Rvir = rvirs[:, 0]
+    assert np.allclose(Rvir, mass_so.M_to_R(masses[mcs], zobs, 'vir'), rtol=1e-12, atol=0) # the final one, it should
+
+    # compute rho_gas profile, use it to compute M_gas within Rdef and T_mgas within Rdef
+    rho0, rhos, rs = gas_normalization(masses[mcs], cvir, Rvir, R_2R200m)
+    Ptot = rho0[:,None] * ks_theta(rds, cvir[:,None], Rvir[:,None])**(1.0 / (Gamma(cvir[:,None]) - 1.0)) * sig2tot_0
+    Rdefs = aperture_radii(masses[mcs], cvir, radii_defs)
+
+    rows = np.zeros(np.shape(beta) + (5, len(mcs), len(radii_defs)))
+    for ip in np.ndindex(np.shape(beta)):
+        fnth = sig2nth_0[ip] / sig2tot_0
         # Now, we have fnth, so we can compute the pressure profile and use it to compute the thermal pressure profile
-        Rvir = mass_so.M_to_R(masses[mc], zobs, 'vir')
-        assert Rvir == Rvir_2 # the final one, it should
-        Rvirs[mc] = Rvir
-
-        # for computing the enclosed mass out to arbitrary radii
-        rhos, rs = profile_nfw.NFWProfile.fundamentalParameters(masses[mc], cvir, zobs, 'vir')
-        # need M(<5R500c) for gas mass normalization
-        M2R200m = quad(lambda x: 4. * np.pi * x**2 * nfw_prof(x, rhos, rs), 0, R_2R200ms[mc])[0]
-
-
-        # compute rho_gas profile, use it to compute M_gas within Rdef and T_mgas within Rdef
-        rho0_by_P0 = 3*eta0(cvirs[mc])**-1 * Rvir/(G*masses[mc])
-        phi0 = -1. * (cvirs[mc] / NFWf(cvirs[mc]))
-        phir = lambda rad: -1. * (cvirs[mc] / NFWf(cvirs[mc])) * (np.log(1. + cvirs[mc]*rad/Rvir) / (cvirs[mc]*rad/Rvir))
-        theta = lambda rad: 1. + ((Gamma(cvirs[mc]) - 1.) / Gamma(cvirs[mc])) * 3. *eta0(cvirs[mc])**-1 * (phi0 - phir(rad))
-
-        rho0_nume = nume = cbf * M2R200m
-        rho0_denom = 4. * np.pi * quad(lambda x: theta(x)**(1.0 / (Gamma(cvirs[mc]) - 1.0)) * x**2, 0, R_2R200ms[mc])[0]
-        # This now pegs the gas mass to be equal to cosmic baryon fraction at 5R500c
-        # NOTE: Both rho0_nume and rho_denom need to be changed if the radius is changed
-        rho0 = rho0_nume / rho0_denom
-        rhogas = lambda rad: rho0 * theta(rad)**(1.0 / (Gamma(cvirs[mc]) - 1.0))
-
-        Tg = mu_plasma * mp_kev_by_kms2 * (1. - fnth) * sig2tots[0,:]
-        Tgf = interp(rds, Tg) # interpolator for Tgas
-
-        Ptot = rhogas(rds) * sig2tots[0,:]
+        Tg = mu_plasma * mp_kev_by_kms2 * (1. - fnth) * sig2tot_0
         Pth  = Ptot * (1.0 - fnth)
-        # compute ySZ profile
-        yprof = p_2_y(rds, Pth)
-        Pth_interp = interp(rds, Pth, k=3)
-
+        # compute ySZ profiles, rds is R200m * rads for every halo so one projection operator serves the whole block
+        yprof = 2.0 * sigmaT_by_mec2 * R200m[:,None] * (Pth @ projection_operator(rads).T)
 
         ### BELOW HERE IS WHERE WE CAN LOOP OVER DIFFERENT RADII ####
+        # rows are (YSZv, YSZrv, Tmgasv, Mgasv, mass_enc) for each halo
+        for k in range(0, len(mcs)):
+            rows[ip + (slice(None), k)] = halo_apertures(cvir[k], Rvir[k], rds[k], rho0[k], rhos[k], rs[k], Tg[k], Pth[k], yprof[k], Rdefs[k])
+    return cvir, Rvir, rows
+
+# MAH arrays of the parent process, attached by each pool worker in _init_worker
+_shared_mah = {}
+
+def share_array(arr):
+    # copy arr into shared memory so that pool workers all read the same buffer instead of a pickled copy
+    buf = RawArray('d', arr.size)
+    np.frombuffer(buf).reshape(arr.shape)[...] = arr
+    return buf, arr.shape
+
+# module settings handed to the pool workers, which import this module afresh and would otherwise only see the defaults
+_worker_tunables = ('Nmah', 'Nradii', 'N_r200m_mult', 'projection_mode', 'aperture_rtol', 'validate_nfw', 'validate_ks',
+                    'nth_kernel', 'nth_scheme', 'snapshot_thin', 'nth_timescale', 'Nthin_check', 'zi', 'zobs')
+
+def worker_pool(cosmo, shared, workers):
+    # forkserver rather than fork: once the parent has run the parallel kernel, forking it can hang the workers at exit
+    tunables = {name: globals()[name] for name in _worker_tunables}
+    return get_context('forkserver').Pool(workers, initializer=_init_worker,
+                                          initargs=(shared, cosmo.name, cosmology.cosmologies.get(cosmo.name), tunables, workers))
+
+def _init_worker(shared, cname, params, tunables, workers):
+    # cosmologies added after import (e.g. by run_cosmologies.py) are only known to the parent, so they come with their parameters
+    if(cname not in cosmology.cosmologies):
+        cosmology.addCosmology(cname, params)
+    cosmology.setCosmology(cname)
+    globals().update(tunables)
+    limit_threads(workers)
+    for key, (buf, shape) in shared.items():
+        _shared_mah[key] = np.frombuffer(buf).reshape(shape)
+
+def _obs_block_worker(task):
+    start, stop, beta, eta, Nbatch, radii_defs = task
+    return obs_block(np.arange(start, stop), _shared_mah['mah'], _shared_mah['concs'], _shared_mah['redshifts'],
+                     _shared_mah['lbtime'], _shared_mah['masses'], _shared_mah['rho_vir'], beta, eta, Nbatch, radii_defs)
+
+def _thin_error_worker(beta, eta):
+    return nth_error_estimate(np.arange(0, min(Nthin_check, Nmah)), _shared_mah['mah'], _shared_mah['concs'], _shared_mah['redshifts'],
+                              _shared_mah['lbtime'], _shared_mah['masses'], _shared_mah['rho_vir'], beta, eta)
+
+def write_checkpoint(checkpoint_dir, run_key, mcs, beta, eta, cvirs, Rvirs, YSZv, YSZrv, Tmgasv, Mgasv, mass_enc):
+    # dump the finished rows for haloes mcs, written under a temporary name and renamed so a chunk is never half-written
+    # run_key is the cache key of the run's inputs, so a restart only picks up chunks of the same run
+    fn = checkpoint_dir / ('chunk_%05d_%05d.npz' % (mcs[0], mcs[-1]))
+    tmp = checkpoint_dir / ('.%s.%d.tmp' % (fn.name, os.getpid()))
+    with open(tmp, 'wb') as f:
+        np.savez(f, run_key=run_key, mcs=mcs, beta=beta, eta=eta, cvirs=cvirs[mcs], Rvirs=Rvirs[mcs], YSZv=YSZv[mcs], YSZrv=YSZrv[mcs],
+                 Tmgasv=Tmgasv[mcs], Mgasv=Mgasv[mcs], mass_enc=mass_enc[mcs])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fn)
+
+def gen_obs(cosmo, beta=beta_def, eta=eta_def, Nbatch=Nbatch, workers=1, checkpoint_dir=None, checkpoint_every=1000, restart=False,
+            radii_defs=radii_definitions):
+    # Nbatch=None integrates one halo at a time, otherwise blocks of Nbatch haloes go through the snapshot loop together
+    # workers > 1 farms the blocks out to a process pool; blocks are the same as in the serial run, so the output is too
+    # with a checkpoint_dir, finished rows are saved every checkpoint_every haloes and restart=True picks them back up
+    # radii_defs are the (mdef, mult) apertures, the last axis of the returned data
+
+    mah, redshifts, lbtime, masses, _, concs = multimah_multiM(zobs, cosmo, Nmah)
+    print("Loaded MAH", flush=True)
+    rho_vir = snapshot_cosmology(redshifts)
 
-        # Loop over Rdef values, make them tuples
-        for itR in range(0,len(radii_definitions)):
-            mdef, mult = radii_definitions[itR]
-            Mdf, Rdef, _ = mass_defs.changeMassDefinition(masses[mc], c=cvir, z=zobs, mdef_in='vir', mdef_out=mdef)
-            Rdef = mult*Rdef
-
-            # integrate ySZ profile out to Rdef
-            YSZv[mc, itR] = YSZ(yprof, rds[:-1], Rdef) # uses an interpolator
-            YSZrv[mc, itR] = YSZr(Pth_interp, Rdef)
-            Mgasv[mc, itR] = 4.0 * np.pi * quad(lambda x: rhogas(x) * x**2, 0, Rdef)[0]
-            Tweighted = 4. * np.pi * quad(lambda x: Tgf(x) * rhogas(x) * x**2, 0, Rdef)[0]
-            Tmgasv[mc, itR] = Tweighted/Mgasv[mc, itR]
-            mass_enc[mc, itR] = quad(lambda x: 4. * np.pi * x**2 * nfw_prof(x, rhos, rs), 0, Rdef)[0]
-
+    cvirs    = np.zeros(Nmah)
+    Rvirs    = np.zeros(Nmah)
+    # The values that we will return and column_stack
+    YSZv     = np.zeros((Nmah, len(radii_defs)))
+    YSZrv     = np.zeros((Nmah, len(radii_defs)))
+    Tmgasv   = np.zeros((Nmah, len(radii_defs)))
+    Mgasv    = np.zeros((Nmah, len(radii_defs)))
+    mass_enc = np.zeros((Nmah, len(radii_defs)))
+
+    done = np.zeros(Nmah, dtype=bool)
+    if(checkpoint_dir is not None):
+        checkpoint_dir = Path(checkpoint_dir)
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        run_key = cache_key(run_inputs(cosmo, beta, eta, radii_defs))
+        if(restart):
+            for fn in sorted(checkpoint_dir.glob('chunk_*.npz')):
+                d = np.load(fn)
+                if('run_key' not in d.files or str(d['run_key']) != run_key):
+                    raise ValueError('%s was written by a run with different inputs, delete the checkpoints to start over' % fn)
+                mcs = d['mcs']
+                cvirs[mcs], Rvirs[mcs] = d['cvirs'], d['Rvirs']
+                YSZv[mcs], YSZrv[mcs], Tmgasv[mcs], Mgasv[mcs], mass_enc[mcs] = d['YSZv'], d['YSZrv'], d['Tmgasv'], d['Mgasv'], d['mass_enc']
+                done[mcs] = True
+            print("Restarting with %d haloes done" % np.sum(done), flush=True)
+        else:
+            for fn in checkpoint_dir.glob('chunk_*.npz'):
+                fn.unlink() # stale chunks from an earlier run
+
+    block = 1 if Nbatch is None else Nbatch
+    starts = [start for start in range(0, Nmah, block) if not np.all(done[start:start + block])]
+    if(workers > 1):
+        shared = {key: share_array(arr) for key, arr in
+                  (('mah', mah), ('concs', concs), ('redshifts', redshifts), ('lbtime', lbtime), ('masses', masses),
+                   ('rho_vir', rho_vir))}
+        pool = worker_pool(cosmo, shared, workers)
+    if(nth_kernel and nth_timescale == 'td' and snapshot_thin > 1):
+        # with a pool this runs in a worker: once the parent has started the kernel's threads, forking it can hang
+        if(workers > 1):
+            err = pool.apply(_thin_error_worker, (beta, eta))
+        else:
+            err = nth_error_estimate(np.arange(0, min(Nthin_check, Nmah)), mah, concs, redshifts, lbtime, masses, rho_vir, beta, eta)
+        print("Max f_nth error (%s) from using every %d-th snapshot: %.2e" % (nth_scheme, snapshot_thin, err), flush=True)
+    if(workers > 1):
+        results = pool.imap(_obs_block_worker, [(start, min(start + block, Nmah), beta, eta, Nbatch, radii_defs) for start in starts])
+    else:
+        results = (obs_block(np.arange(start, min(start + block, Nmah)), mah, concs, redshifts, lbtime, masses, rho_vir, beta, eta, Nbatch, radii_defs)
+                   for start in starts)
+
+    pending = [] # haloes finished since the last checkpoint
+    for start, (cvir, Rvir, rows) in zip(starts, results):
+        if(start % 100 == 0 or Nbatch is not None):
+            print(start, flush=True)
+        mcs = np.arange(start, start + len(cvir))
+        cvirs[mcs] = cvir
+        Rvirs[mcs] = Rvir
+        YSZv[mcs], YSZrv[mcs], Tmgasv[mcs], Mgasv[mcs], mass_enc[mcs] = rows
+        pending.extend(mcs)
+        if(checkpoint_dir is not None and checkpoint_every > 0 and (len(pending) >= checkpoint_every or start == starts[-1])):
+            write_checkpoint(checkpoint_dir, run_key, np.array(pending), beta, eta, cvirs, Rvirs, YSZv, YSZrv, Tmgasv, Mgasv, mass_enc)
+            pending = []
+    if(workers > 1):
+        pool.close()
+        pool.join()
 
     return np.stack((mass_enc, Tmgasv, Mgasv, YSZv, YSZrv)), cvirs, Rvirs
     # the masses should be same as Mvirs and they're the same for all cosmologies anyway
 
-print("Finished load-in stuff", flush=True)
-
-data, cvirs, Rvirs = gen_obs(cosmo, beta=beta_def, eta=eta_def)
-np.savez('%s_data.npz' % cname, data=data, cvirs=cvirs, Rvirs=Rvirs)
+def gen_obs_sweep(cosmo, betas, etas, Nbatch=Nbatch, workers=1, radii_defs=radii_definitions):
+    # gen_obs over the grid betas x etas in one pass over the haloes, see obs_block
+    # returns the observables as (len(betas), len(etas), 5, Nmah, len(radii_defs)), plus cvirs and Rvirs
+    assert nth_kernel and nth_timescale == 'td'
+    mah, redshifts, lbtime, masses, _, concs = multimah_multiM(zobs, cosmo, Nmah)
+    print("Loaded MAH", flush=True)
+    rho_vir = snapshot_cosmology(redshifts)
+    beta_grid, eta_grid = np.meshgrid(betas, etas, indexing='ij')
+
+    cvirs = np.zeros(Nmah)
+    Rvirs = np.zeros(Nmah)
+    cube  = np.zeros(beta_grid.shape + (5, Nmah, len(radii_defs)))
+    block = 1 if Nbatch is None else Nbatch
+    starts = list(range(0, Nmah, block))
+    if(workers > 1):
+        shared = {key: share_array(arr) for key, arr in
+                  (('mah', mah), ('concs', concs), ('redshifts', redshifts), ('lbtime', lbtime), ('masses', masses),
+                   ('rho_vir', rho_vir))}
+        pool = worker_pool(cosmo, shared, workers)
+        results = pool.imap(_obs_block_worker, [(start, min(start + block, Nmah), beta_grid, eta_grid, Nbatch, radii_defs) for start in starts])
+    else:
+        results = (obs_block(np.arange(start, min(start + block, Nmah)), mah, concs, redshifts, lbtime, masses, rho_vir,
+                             beta_grid, eta_grid, Nbatch, radii_defs) for start in starts)
+    for start, (cvir, Rvir, rows) in zip(starts, results):
+        print(start, flush=True)
+        mcs = np.arange(start, start + len(cvir))
+        cvirs[mcs] = cvir
+        Rvirs[mcs] = Rvir
+        cube[..., mcs, :] = rows
+    if(workers > 1):
+        pool.close()
+        pool.join()
+
+    # same order of observables as gen_obs
+    return cube[:, :, [4, 2, 3, 0, 1]], cvirs, Rvirs
+
+def run_inputs(cosmo, beta=beta_def, eta=eta_def, radii_defs=radii_definitions):
+    # everything that changes the output of gen_obs, hashed into the result cache key
+    store = open_mah_store(multimah_root / cosmo.name, Nmah)
+    return {'cosmology': cosmology_params(cosmo), 'mah_checksum': store['checksum'],
+            'beta': beta, 'eta': eta, 'Nmah': Nmah, 'Nradii': Nradii, 'N_r200m_mult': N_r200m_mult, 'zi': zi, 'zobs': zobs,
+            'radii_defs': radii_defs, 'conc_model': conc_model.__name__, 'projection_mode': projection_mode,
+            'aperture_rtol': aperture_rtol, 'nth_kernel': nth_kernel, 'nth_scheme': nth_scheme, 'snapshot_thin': snapshot_thin,
+            'nth_timescale': nth_timescale}
+
+def cached_gen_obs(cosmo, cache_dir, cache_budget=None, beta=beta_def, eta=eta_def, radii_defs=radii_definitions, **kwargs):
+    # gen_obs through the result cache: returns the stored (data, cvirs, Rvirs) straight away if this exact run was done before
+    # kwargs go to gen_obs; they only change how the work is split up, not the result
+    inputs = run_inputs(cosmo, beta, eta, radii_defs)
+    key = cache_key(inputs)
+    hit = cache_lookup(cache_dir, key)
+    if(hit is not None):
+        print("Found %s in the cache" % key, flush=True)
+        return hit['data'], hit['cvirs'], hit['Rvirs']
+    t0 = time.time()
+    data, cvirs, Rvirs = gen_obs(cosmo, beta=beta, eta=eta, radii_defs=radii_defs, **kwargs)
+    if(not np.all(np.isfinite(data))):
+        print("%d haloes have non-finite observables, not caching %s" % (np.sum(~np.isfinite(data).all(axis=(0, 2))), key), flush=True)
+        return data, cvirs, Rvirs
+    cache_store(cache_dir, key, inputs, {'data': data, 'cvirs': cvirs, 'Rvirs': Rvirs}, cache_budget,
+                cosmology_name=cosmo.name, runtime_s=time.time() - t0)
+    return data, cvirs, Rvirs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monte Carlo scaling-relation observables for one cosmology')
+    parser.add_argument('cname', help='cosmology name from the ones above')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes to split the haloes over')
+    parser.add_argument('--nbatch', type=int, default=Nbatch, help='haloes per block, 0 to integrate one halo at a time')
+    parser.add_argument('--checkpoint-dir', default=None, help='directory for checkpoint chunks, defaults to <cname>_checkpoints')
+    parser.add_argument('--checkpoint-every', type=int, default=1000, help='haloes between checkpoints, 0 to disable')
+    parser.add_argument('--restart', action='store_true', help='skip the haloes already saved in the checkpoint directory')
+    parser.add_argument('--cache-dir', default='obs_cache', help='result cache directory')
+    parser.add_argument('--cache-gb', type=float, default=20., help='size budget of the result cache in GB')
+    parser.add_argument('--no-cache', action='store_true', help='always recompute and do not store the result')
+    parser.add_argument('--sweep-beta', nargs='*', type=float, default=[], help='beta values of a (beta, eta) grid run, saved to <cname>_sweep.npz')
+    parser.add_argument('--sweep-eta', nargs='*', type=float, default=[], help='eta values of a (beta, eta) grid run')
+    parser.add_argument('--extra-apertures', nargs='*', default=[], metavar='MDEF:MULT',
+                        help='apertures appended to radii_definitions, e.g. 500c:1.5 200m:3')
+    args = parser.parse_args()
+
+    cname = args.cname # load in cosmology name from the ones above
+    cosmo = cosmology.setCosmology(cname)
+
+    print("Finished load-in stuff", flush=True)
+
+    radii_defs = radii_definitions + [(ap.split(':')[0], float(ap.split(':')[1])) for ap in args.extra_apertures]
+    if(args.sweep_beta or args.sweep_eta):
+        betas = args.sweep_beta or [beta_def]
+        etas = args.sweep_eta or [eta_def]
+        cube, cvirs, Rvirs = gen_obs_sweep(cosmo, betas, etas, Nbatch=args.nbatch or None, workers=args.workers, radii_defs=radii_defs)
+        np.savez('%s_sweep.npz' % cname, data=cube, betas=betas, etas=etas, cvirs=cvirs, Rvirs=Rvirs)
+        raise SystemExit
+
+    checkpoint_dir = args.checkpoint_dir or '%s_checkpoints' % cname
+    run_args = dict(beta=beta_def, eta=eta_def, Nbatch=args.nbatch or None, workers=args.workers, checkpoint_dir=checkpoint_dir,
+                    checkpoint_every=args.checkpoint_every, restart=args.restart, radii_defs=radii_defs)
+    if(args.no_cache):
+        data, cvirs, Rvirs = gen_obs(cosmo, **run_args)
+    else:
+        data, cvirs, Rvirs = cached_gen_obs(cosmo, args.cache_dir, args.cache_gb * 1e9, **run_args)
+    np.savez('%s_data.npz' % cname, data=data, cvirs=cvirs, Rvirs=Rvirs)
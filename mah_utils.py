@@ -0,0 +1,243 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from pathlib import Path
+from os.path import isfile
+from multiprocessing import Pool, current_process
+from colossus.halo import mass_defs
+
+# helpers for the Monte Carlo MAH arrays shared by gen_mc_observables.py and the analysis notebook
+# the MAH arrays are (Nmah, nz) with snapshot 0 at z=0, so each row runs backwards in time
+
+
+def last_index_above(mah, thresh):
+    '''
+    For each halo (row of mah), the last snapshot where the mass exceeds thresh,
+    i.e. np.where(mah[k,:] > thresh[k])[0][-1] done row-by-row.
+    thresh is (Nmah,) for one threshold per halo or (Nmah, n) for several.
+    Rows are non-increasing, so each lookup is a searchsorted on the reversed row;
+    any row that is not monotone falls back to the linear scan.
+    '''
+    thresh = np.asarray(thresh, dtype=float)
+    one_per_halo = (thresh.ndim == 1)
+    thresh = thresh.reshape(len(mah), -1)
+    nz = mah.shape[1]
+    inds = np.zeros(thresh.shape, dtype=int)
+    for k in range(0, len(mah)):
+        row = np.asarray(mah[k])
+        if(np.all(row[1:] <= row[:-1])):
+            inds[k] = nz - 1 - np.searchsorted(row[::-1], thresh[k], side='right')
+        else:
+            above = row[None, :] > thresh[k][:, None]
+            inds[k] = nz - 1 - np.argmax(above[:, ::-1], axis=1)
+    if(one_per_halo):
+        return inds[:, 0]
+    return inds
+
+
+def t04_table(mah):
+    # snapshot index of t04 for every (halo, snapshot): the last snapshot where the
+    # halo was still above 4% of its mass at that snapshot
+    return last_index_above(mah, 0.04 * mah)
+
+
+def conc_table(t04_inds, lbtime, t0, conc_model):
+    # concentrations for every (halo, snapshot) from the t04 table, with c = conc_model(t, t04)
+    return conc_model(t0 - lbtime[None, :], t0 - lbtime[t04_inds])
+
+
+def interp_log_mah(mah, zeds, z):
+    # M(z) of every halo at the redshifts z (n,), linear in log M between the snapshots of the shared
+    # (increasing) redshift axis zeds; returns (Nmah, n)
+    z = np.atleast_1d(np.asarray(z, dtype=float))
+    k = np.clip(np.searchsorted(zeds, z, side='right') - 1, 0, len(zeds) - 2)
+    w = (z - zeds[k]) / (zeds[k+1] - zeds[k])
+    lnM = np.log(np.maximum(mah[:, k], np.finfo(float).tiny)) * (1. - w) + \
+          np.log(np.maximum(mah[:, k+1], np.finfo(float).tiny)) * w
+    return np.exp(lnM)
+
+
+def mar_windows(mah, zeds, lbtime, t0, windows, conc_model, mdef_out='200m'):
+    '''
+    Accretion rates Gamma = dlog10(M_mdef_out) / dlog10(a) of every halo over each (zf, zi) window,
+    as (Nmah, len(windows)). Mvir at every window edge comes from interp_log_mah, all edges in
+    one pass; the concentrations for the conversion to mdef_out are conc_model(t, t04), with
+    t04 from the snapshots where the halo was last above 4% of the interpolated mass.
+    For windows whose edges are snapshots this is MAR in the notebook.
+    '''
+    windows = np.atleast_2d(np.asarray(windows, dtype=float))
+    edges, inv = np.unique(windows, return_inverse=True)
+    inv = inv.reshape(windows.shape)
+    mvirs = interp_log_mah(mah, zeds, edges)
+    t04_inds = last_index_above(mah, 0.04 * mvirs)
+    t_edges = t0 - np.interp(edges, zeds, lbtime)
+    concs = conc_model(t_edges[None, :], t0 - lbtime[t04_inds])
+    log_mdef = np.zeros(mvirs.shape)
+    for j, z in enumerate(edges):
+        log_mdef[:, j] = np.log10(mass_defs.changeMassDefinition(mvirs[:, j], concs[:, j], z, 'vir', mdef_out)[0])
+    delta_log_a = np.log10(1. + windows[:, 1]) - np.log10(1. + windows[:, 0])
+    return (log_mdef[:, inv[:, 0]] - log_mdef[:, inv[:, 1]]) / delta_log_a
+
+
+# binary MAH store: the MAH%04d.dat files of one MultiTree output directory parsed once into .npy files that are
+# memory-mapped on open. meta.json records the shape, a checksum of the arrays and a signature of the source files,
+# so the store is rebuilt whenever the source files change (or more haloes are asked for than it holds)
+
+def source_files(mah_dir, Nmah):
+    # the MAH files of the first Nmah haloes, plus halomasses.dat if the directory has one
+    mah_dir = Path(mah_dir)
+    files = [mah_dir / ('MAH%04d.dat' % (i+1)) for i in range(0, Nmah)]
+    if(isfile(mah_dir / 'halomasses.dat')):
+        files.append(mah_dir / 'halomasses.dat')
+    return files
+
+
+def source_signature(files):
+    # cheap fingerprint of the source files: name, size and modification time of each
+    sig = hashlib.sha1()
+    for fn in files:
+        st = os.stat(fn)
+        sig.update(('%s %d %d\n' % (fn.name, st.st_size, st.st_mtime_ns)).encode())
+    return sig.hexdigest()
+
+
+def arrays_checksum(arrays):
+    # sha256 over the raw bytes of the arrays, in name order
+    chk = hashlib.sha256()
+    for name in sorted(arrays):
+        chk.update(name.encode())
+        chk.update(np.ascontiguousarray(arrays[name]).tobytes())
+    return chk.hexdigest()
+
+
+def _read_mah_column(fn):
+    # log10(M(z)/M(z=0)) column of one MultiTree MAH file
+    return np.loadtxt(fn, usecols=3)
+
+
+def ingest_mah(mah_dir, Nmah, store='mah_store', workers=None):
+    '''
+    Parse MAH0001.dat ... MAH<Nmah>.dat in mah_dir into the binary store mah_dir/store.
+    The files are parsed by a pool of workers (all cores by default). The store holds
+    mah (Nmah, nz) as M(z)/M(z=0), redshifts and lbtime (nz,), and masses (Nmah,) if
+    the directory has a halomasses.dat. It is written to a temporary directory and
+    moved into place once complete, so an interrupted ingest never leaves a partial store.
+    '''
+    mah_dir = Path(mah_dir)
+    files = source_files(mah_dir, Nmah)
+    dat1 = np.loadtxt(files[0])
+    arrays = {'redshifts': dat1[:, 1], 'lbtime': dat1[:, 2]}
+    if(workers == 1 or current_process().daemon):
+        # pool workers cannot start pools of their own
+        cols = [_read_mah_column(fn) for fn in files[:Nmah]]
+    else:
+        with Pool(workers) as pool:
+            cols = pool.map(_read_mah_column, files[:Nmah], chunksize=max(1, Nmah // (8 * (workers or os.cpu_count()))))
+    arrays['mah'] = 10**np.array(cols)
+    if(len(files) > Nmah):
+        arrays['masses'] = 10**np.loadtxt(files[-1])[:Nmah]
+    write_store(mah_dir / store, arrays, source_signature(files))
+
+
+def ingest_npz(npz_fn, store):
+    '''
+    Convert a legacy MAH cache npz (dat as absolute masses, redshifts, lbtime, masses, as
+    multimah_multiM in the notebook used to save them) into the binary store at path store,
+    with the npz itself as the source. Any t04/concentration tables in it are recomputed.
+    '''
+    npz_fn = Path(npz_fn)
+    with np.load(npz_fn) as d:
+        masses = d['masses']
+        arrays = {'mah': d['dat'] / masses[:, None], 'redshifts': d['redshifts'], 'lbtime': d['lbtime'], 'masses': masses}
+    write_store(Path(store), arrays, source_signature([npz_fn]))
+
+
+def write_store(path, arrays, source):
+    # write arrays to the store directory path, via a temporary directory that is moved into place once complete
+    path = Path(path)
+    tmp = path.parent / (path.name + '.tmp')
+    if(os.path.isdir(tmp)):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for name, arr in arrays.items():
+        np.save(tmp / (name + '.npy'), arr)
+    meta = {'Nmah': len(arrays['mah']), 'nz': arrays['mah'].shape[1], 'arrays': sorted(arrays), 'derived': [],
+            'checksum': arrays_checksum(arrays), 'source': source}
+    with open(tmp / 'meta.json', 'w') as f:
+        json.dump(meta, f)
+    if(os.path.isdir(path)):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+
+def open_mah_store(mah_dir, Nmah, store='mah_store', verify=False, workers=None):
+    '''
+    Open the binary store of mah_dir, (re)building it first if it is missing, holds fewer
+    than Nmah haloes, or the source files have changed since it was built.
+    Returns a dict of the stored arrays, memory-mapped read-only, so nothing is read
+    until it is used; slice [:Nmah] for the first Nmah haloes. verify=True reads
+    everything once and checks it against the checksum in meta.json.
+    '''
+    path = Path(mah_dir) / store
+    meta = None
+    if(isfile(path / 'meta.json')):
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+        if(meta['Nmah'] < Nmah or meta['source'] != source_signature(source_files(mah_dir, meta['Nmah']))):
+            meta = None
+    if(meta is None):
+        ingest_mah(mah_dir, Nmah, store, workers)
+    return load_store(path, verify)
+
+
+def open_npz_store(npz_fn, Nmah, verify=False):
+    '''
+    open_mah_store for a legacy MAH cache npz (see ingest_npz): the store sits next to it as
+    <name>_store and is rebuilt whenever the npz changes.
+    '''
+    npz_fn = Path(npz_fn)
+    path = npz_fn.parent / (npz_fn.stem + '_store')
+    meta = None
+    if(isfile(path / 'meta.json')):
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+    if(meta is None or meta['source'] != source_signature([npz_fn])):
+        ingest_npz(npz_fn, path)
+    store = load_store(path, verify)
+    if(len(store['mah']) < Nmah):
+        raise ValueError('%s holds %d haloes, %d asked for' % (npz_fn, len(store['mah']), Nmah))
+    return store
+
+
+def load_store(path, verify=False):
+    # memory-map the arrays of the store at path, see open_mah_store
+    with open(path / 'meta.json') as f:
+        meta = json.load(f)
+    arrays = {name: np.load(path / (name + '.npy'), mmap_mode='r') for name in meta['arrays']}
+    if(verify and arrays_checksum(arrays) != meta['checksum']):
+        raise IOError('MAH store %s does not match its checksum, delete it to rebuild' % path)
+    for name in meta['derived']:
+        arrays[name] = np.load(path / (name + '.npy'), mmap_mode='r')
+    arrays['path'] = path
+    arrays['checksum'] = meta['checksum']
+    return arrays
+
+
+def save_derived(store, **tables):
+    # add tables computed from the MAH alone (t04 indices, ...) to an open store; they are dropped along
+    # with the store whenever it is rebuilt, so anything that also depends on the cosmology or a model
+    # (e.g. the concentrations) must not be saved here
+    path = store['path']
+    with open(path / 'meta.json') as f:
+        meta = json.load(f)
+    for name, arr in tables.items():
+        np.save(path / (name + '.npy'), arr)
+        store[name] = np.load(path / (name + '.npy'), mmap_mode='r')
+        if(name not in meta['derived']):
+            meta['derived'].append(name)
+    tmp = path / 'meta.json.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, path / 'meta.json')
@@ -0,0 +1,76 @@
+import io
+import json
+import hashlib
+import sqlite3
+import numpy as np
+from run_cache import _canonical, cosmology_params
+
+# one SQLite store for the outputs of the average-MAH model codes (vdb_mah / zhao_mah in the analysis notebook),
+# in place of one file per run named from the rounded mass and redshift. Each row is the raw output table of one
+# run, keyed by the model, a hash of the full cosmology parameters, tp, log10(Mobs) and z_obs. SQLite does the
+# locking, so several notebook kernels can read and write the same store at once
+
+store_version = 1 # bump when the meaning of the stored tables changes; independent of run_cache.cache_version
+
+_schema = '''CREATE TABLE IF NOT EXISTS mah (
+    model TEXT, cosmo TEXT, tp TEXT, lgM REAL, z REAL, data BLOB,
+    PRIMARY KEY (model, cosmo, tp, lgM, z))'''
+
+
+def open_model_store(fn):
+    # check_same_thread=False so that callbacks from model_runner's thread can write results
+    db = sqlite3.connect(str(fn), timeout=600, check_same_thread=False)
+    db.execute(_schema)
+    db.commit()
+    return db
+
+
+def cosmology_key(cosmo):
+    # sha256 of the canonical JSON of the cosmology parameters, so bumping run_cache.cache_version
+    # does not orphan the model runs already in the store
+    inputs = dict(cosmology_params(cosmo), store_version=store_version)
+    return hashlib.sha256(json.dumps(_canonical(inputs), sort_keys=True).encode()).hexdigest()
+
+
+def _to_blob(arr):
+    buf = io.BytesIO()
+    np.save(buf, np.asarray(arr), allow_pickle=False)
+    return buf.getvalue()
+
+
+def _from_blob(blob):
+    return np.load(io.BytesIO(blob), allow_pickle=False)
+
+
+def store_put(db, model, cosmo, tp, Mobs, z_obs, data):
+    # save the output table of one run; a second run with the same key replaces the first
+    with db:
+        db.execute('INSERT OR REPLACE INTO mah VALUES (?, ?, ?, ?, ?, ?)',
+                   (model, cosmology_key(cosmo), tp, float(np.log10(Mobs)), float(z_obs), _to_blob(data)))
+
+
+def store_get_many(db, model, cosmo, tp, Mobs, z_obs, dlgM=1e-9, dz=1e-9):
+    '''
+    Output tables for the masses Mobs (array) at z_obs, one query for the whole grid.
+    Each mass gets the stored run nearest in log10(M) among those within dlgM in log10(M) and dz
+    in z, or None if there is none; widen dlgM/dz to accept nearest-neighbour answers.
+    '''
+    lgM = np.log10(np.atleast_1d(Mobs))
+    rows = db.execute('SELECT lgM, z, data FROM mah WHERE model=? AND cosmo=? AND tp=? AND z BETWEEN ? AND ? '
+                      'AND lgM BETWEEN ? AND ?', (model, cosmology_key(cosmo), tp, z_obs - dz, z_obs + dz,
+                                                 float(np.min(lgM)) - dlgM, float(np.max(lgM)) + dlgM)).fetchall()
+    out = [None] * len(lgM)
+    if(len(rows) == 0):
+        return out
+    lgM_st = np.array([row[0] for row in rows])
+    z_st = np.array([row[1] for row in rows])
+    for k, lm in enumerate(lgM):
+        best = np.argmin(np.abs(lgM_st - lm) + np.abs(z_st - z_obs))
+        if(np.abs(lgM_st[best] - lm) <= dlgM):
+            out[k] = _from_blob(rows[best][2])
+    return out
+
+
+def store_get(db, model, cosmo, tp, Mobs, z_obs, dlgM=1e-9, dz=1e-9):
+    # output table of a single run, or None, see store_get_many
+    return store_get_many(db, model, cosmo, tp, [Mobs], z_obs, dlgM, dz)[0]
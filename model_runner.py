@@ -0,0 +1,58 @@
+import os
+import shutil
+import asyncio
+import tempfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# runs the average-MAH model executables (getPWGH, mandc.x) concurrently. Each run gets its own scratch
+# directory, so outputs with fixed names such as PWGH_average.dat cannot collide, and at most nproc
+# executables run at a time. A job is (executable, stdin text, output file name, np.loadtxt kwargs)
+
+
+async def _run_job(sem, job, scratch_root):
+    exe, instring, out_name, loadtxt_kwargs = job
+    async with sem:
+        scratch = tempfile.mkdtemp(prefix='mah_', dir=scratch_root)
+        try:
+            proc = await asyncio.create_subprocess_exec(exe, cwd=scratch, stdin=asyncio.subprocess.PIPE,
+                                                        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+            _, err = await proc.communicate(instring.encode())
+            out = os.path.join(scratch, out_name)
+            if(proc.returncode != 0 or not os.path.isfile(out)):
+                raise RuntimeError('%s exited with %s and no %s:\n%s' % (exe, proc.returncode, out_name, err.decode()))
+            return np.loadtxt(out, **loadtxt_kwargs)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+async def iter_models(jobs, nproc=None, scratch_root=None):
+    '''
+    Async generator over the jobs: yields (index into jobs, parsed output array) as each run completes,
+    with up to nproc (default: all cores) executables at once. scratch_root is where the per-run scratch
+    directories go (default: the system temp directory).
+    '''
+    sem = asyncio.Semaphore(nproc or os.cpu_count())
+
+    async def indexed(k, job):
+        return k, await _run_job(sem, job, scratch_root)
+    for done in asyncio.as_completed([indexed(k, job) for k, job in enumerate(jobs)]):
+        yield await done
+
+
+def run_models(jobs, nproc=None, scratch_root=None, callback=None):
+    # blocking version of iter_models: the outputs in the order of jobs; callback(index, data) is called as each completes
+    async def collect():
+        out = [None] * len(jobs)
+        async for k, data in iter_models(jobs, nproc, scratch_root):
+            out[k] = data
+            if(callback is not None):
+                callback(k, data)
+        return out
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(collect())
+    # inside a running event loop (e.g. a Jupyter kernel), so run ours in a thread
+    with ThreadPoolExecutor(1) as ex:
+        return ex.submit(asyncio.run, collect()).result()
@@ -0,0 +1,167 @@
+import numpy as np
+import colossus
+from numba import njit, prange, set_num_threads, config
+
+# compiled sig2nth integration shared by gen_mc_observables.py (gen_obs) and the analysis notebook (gen_fnth)
+# same model as sig2_tot, t_d, Gamma and eta0 there, written out per (halo, radius) so the time loop
+# runs without allocating anything; every (halo, radius) pair is independent, so they are split over threads.
+# The Brunt-Vaisala timescale at the end is plain numpy instead, since it needs whole radial profiles
+
+G = colossus.utils.constants.G
+cm_per_km = 1e5
+km_per_kpc = colossus.utils.constants.KPC / cm_per_km # KPC was in cm
+s_per_Gyr = colossus.utils.constants.GYR
+
+
+@njit(nogil=True, cache=True)
+def _NFWf(x):
+    return np.log(1. + x) - x/(1. + x)
+
+
+@njit(nogil=True, cache=True)
+def _sig2_tot(r, M, c, R):
+    Gm = 1.15 + 0.01*(c - 6.5)
+    eta0 = 0.00676*(c - 6.5)**2 + 0.206*(c - 6.5) + 2.48
+    rho0_by_P0 = 3*eta0**-1 * R/(G*M)
+    phi0 = -1. * (c / _NFWf(c))
+    phir = -1. * (c / _NFWf(c)) * (np.log(1. + c*r/R) / (c*r/R))
+    theta = 1. + ((Gm - 1.) / Gm) * 3. *eta0**-1 * (phi0 - phir)
+    return (1.0 / rho0_by_P0) * theta
+
+
+@njit(nogil=True, cache=True)
+def _t_dyn(r, M, c, R, h):
+    # t_d = beta * t_dyn / s_per_Gyr / 2, the part that does not depend on beta
+    Menc = M * _NFWf(c*r/R) / _NFWf(c)
+    return 2. * np.pi * (r**3 / (G*Menc))**(1./2.) * km_per_kpc / h
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def _integrate(mass, conc, R, dt, first, rads, h, betas, etas, init_etas, dsig_pos, expo, sig2nth, sig2tot):
+    # sig2nth is (npar, nhalo, nrad) and doubles as the state of the recursion for every (beta, eta) pair;
+    # sig2tot, dsig2tot/dt and t_dyn are computed once per step and shared by all of them.
+    # dt is (nhalo, nsnap-1), and halo b starts at snapshot first[b]
+    nhalo, nrad = rads.shape
+    nsnap = mass.shape[1]
+    npar = len(betas)
+    for k in prange(nhalo * nrad):
+        b = k // nrad
+        j = k % nrad
+        r = rads[b, j]
+        i0 = first[b]
+        s2tot_1 = _sig2_tot(r, mass[b, i0], conc[b, i0], R[b, i0])
+        for i in range(i0 + 1, nsnap):
+            s2tot_2 = _sig2_tot(r, mass[b, i], conc[b, i], R[b, i])
+            ds2dt = (s2tot_2 - s2tot_1) / dt[b, i-1]
+            if(i == i0 + 1):
+                for p in range(npar):
+                    sig2nth[p, b, j] = init_etas[p] * s2tot_2
+            else:
+                if(dsig_pos and ds2dt < 0):
+                    ds2dt = 0.
+                t_dyn = _t_dyn(r, mass[b, i], conc[b, i], R[b, i], h)
+                for p in range(npar):
+                    s2nth = sig2nth[p, b, j]
+                    td = betas[p] * t_dyn / s_per_Gyr / 2.
+                    if(expo):
+                        # exact solution of dsig2nth/dt = -sig2nth/td + eta*ds2dt with td and ds2dt fixed over the step
+                        decay = np.exp(-dt[b, i-1] / td)
+                        s2nth = s2nth * decay - etas[p] * ds2dt * td * np.expm1(-dt[b, i-1] / td)
+                    else:
+                        s2nth = s2nth + ((-1. * s2nth / td) + etas[p] * ds2dt)*dt[b, i-1]
+                    if(s2nth < 0):
+                        s2nth = 0. #can't have negative sigma^2_nth at any point in time
+                    sig2nth[p, b, j] = s2nth
+            s2tot_1 = s2tot_2
+        sig2tot[b, j] = s2tot_1
+
+
+def thin_snapshots(nsnap, thin):
+    # every thin-th snapshot, always keeping the first and the last
+    return np.unique(np.append(np.arange(0, nsnap, thin), nsnap - 1))
+
+
+def integrate_sig2nth(mass, conc, R, dt, rads, h, beta, eta, init_eta=None, dsig_pos=False, scheme='euler', thin=1, first=None):
+    '''
+    Integrate sig2nth from the first snapshot to the last, for one halo or a block of them.
+    mass, conc and R are (nsnap,) or (nhalo, nsnap) and run forwards in time, dt is the (nsnap-1,)
+    time in Gyr between consecutive snapshots (or (nhalo, nsnap-1) when the haloes have their own
+    snapshot times), and rads is (nrad,) or (nhalo, nrad) in physical kpc/h. first (nhalo,) is the
+    snapshot each halo starts at, so histories of different lengths can be padded at the front.
+    The first step sets sig2nth = init_eta * sig2tot (init_eta defaults to eta); dsig_pos clamps
+    negative dsig2tot/dt to zero. scheme is 'euler' for the forward Euler step, or 'exp' to take the
+    decay term exactly, which stays stable for dt > t_d. thin > 1 steps over every thin-th snapshot only.
+    beta and eta can also be equal-length arrays of (beta, eta) pairs, which are all integrated in the
+    same pass; sig2nth then gets a leading axis over the pairs.
+    Returns the final sig2nth and sig2tot, shaped like rads.
+    '''
+    assert scheme in ('euler', 'exp')
+    one_halo = (np.ndim(mass) == 1)
+    one_par = (np.ndim(beta) == 0)
+    betas, etas = np.broadcast_arrays(np.atleast_1d(np.asarray(beta, dtype=float)), np.atleast_1d(np.asarray(eta, dtype=float)))
+    init_etas = etas if init_eta is None else np.full(len(etas), float(init_eta))
+    mass = np.atleast_2d(mass)
+    conc = np.atleast_2d(conc)
+    R = np.atleast_2d(R)
+    assert mass.shape == conc.shape == R.shape and np.shape(dt)[-1] == mass.shape[1] - 1
+    assert thin == 1 or first is None # thin padded histories before padding them
+    if(thin > 1):
+        keep = thin_snapshots(mass.shape[1], thin)
+        mass, conc, R = mass[:, keep], conc[:, keep], R[:, keep]
+        dt = np.diff(np.concatenate((np.zeros(np.shape(dt)[:-1] + (1,)), np.cumsum(dt, axis=-1)), axis=-1)[..., keep], axis=-1)
+    mass = np.ascontiguousarray(mass, dtype=float)
+    conc = np.ascontiguousarray(conc, dtype=float)
+    R = np.ascontiguousarray(R, dtype=float)
+    rads = np.ascontiguousarray(np.broadcast_to(rads, (len(mass), np.shape(rads)[-1])), dtype=float)
+    dt = np.ascontiguousarray(np.broadcast_to(dt, (len(mass), mass.shape[1] - 1)), dtype=float)
+    first = np.zeros(len(mass), dtype=np.int64) if first is None else np.ascontiguousarray(first, dtype=np.int64)
+    sig2nth = np.zeros((len(betas),) + rads.shape)
+    sig2tot = np.zeros(rads.shape)
+    _integrate(mass, conc, R, dt, first, rads, float(h), np.ascontiguousarray(betas), np.ascontiguousarray(etas),
+               np.ascontiguousarray(init_etas), bool(dsig_pos), scheme == 'exp', sig2nth, sig2tot)
+    if(one_par):
+        sig2nth = sig2nth[0]
+    if(one_halo):
+        return sig2nth[..., 0, :], sig2tot[0]
+    return sig2nth, sig2tot
+
+
+def thinning_error(mass, conc, R, dt, rads, h, beta, eta, scheme, thin, **kwargs):
+    # error estimate for a thinned run: max |f_nth(every thin-th snapshot) - f_nth(every snapshot)| over all haloes and radii
+    sig2nth, sig2tot = integrate_sig2nth(mass, conc, R, dt, rads, h, beta, eta, scheme=scheme, **kwargs)
+    sig2nth_thin, sig2tot_thin = integrate_sig2nth(mass, conc, R, dt, rads, h, beta, eta, scheme=scheme, thin=thin, **kwargs)
+    return np.max(np.abs(sig2nth_thin / sig2tot_thin - sig2nth / sig2tot))
+
+
+def limit_threads(nproc):
+    # share the cores between nproc processes that each run the kernel, e.g. in a multiprocessing pool
+    set_num_threads(max(1, config.NUMBA_NUM_THREADS // nproc))
+
+
+def ks_dlnK_dlnr(rads, c, R, fnth, gamma=5./3.):
+    '''
+    dlnK/dlnr of the gas entropy for the KS profile with the nonthermal fraction fnth, at radii rads that are
+    log-spaced along the last axis with the same spacing in every row (e.g. (nhalo, nrad) = fixed fractions of
+    R200m); c and R broadcast against rads, e.g. as (nhalo, 1) columns. Second-order finite differences in ln r
+    on that grid, so whole blocks of haloes are done at once without a spline per profile.
+    '''
+    Gm = 1.15 + 0.01*(c - 6.5)
+    eta0 = 0.00676*(c - 6.5)**2 + 0.206*(c - 6.5) + 2.48
+    NFWf_c = np.log(1. + c) - c/(1. + c)
+    phi0 = -1. * (c / NFWf_c)
+    phir = -1. * (c / NFWf_c) * (np.log(1. + c*rads/R) / (c*rads/R))
+    theta = 1. + ((Gm - 1.) / Gm) * 3. *eta0**-1 * (phi0 - phir)
+    lnK = ((Gm - gamma) / (Gm - 1.) * np.log(theta)) + np.log(1. - fnth)
+    dlnr = np.log(rads[..., 1] / rads[..., 0]).flat[0]
+    return np.gradient(lnK, dlnr, axis=-1, edge_order=2)
+
+
+def t_bv(rads, M, c, R, fnth, beta, h, gamma=5./3., unstable=np.inf):
+    # beta / N_BV in Gyr, the Brunt-Vaisala alternative to t_d, on the same grids as ks_dlnK_dlnr.
+    # Where N_BV^2 <= 0 (dlnK/dlnr <= 0, convectively unstable or neutral gas) there is no buoyant restoring
+    # force; the timescale there is unstable, by default inf, i.e. no dissipation. np.nan marks those radii instead
+    x = c*rads/R
+    g = -G*M * (np.log(1. + x) - x/(1. + x)) / ((np.log(1. + c) - c/(1. + c)) * rads**2)
+    N2 = -1. * g / gamma * ks_dlnK_dlnr(rads, c, R, fnth, gamma) / rads
+    stable = N2 > 0
+    return np.where(stable, beta / np.sqrt(np.where(stable, N2, 1.)) * km_per_kpc / h / s_per_Gyr, unstable)
@@ -0,0 +1,115 @@
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import subprocess
+import numpy as np
+from pathlib import Path
+
+# content-addressed cache of gen_obs results: each entry is <key>.npz with a <key>.json of provenance next to it,
+# where key is the sha256 of every input that affects the result. The .json modification time is the last use,
+# which is what the least-recently-used eviction goes by
+
+cache_version = 2 # bump when the meaning of the cached arrays changes
+
+
+def _canonical(obj):
+    # JSON-able version of obj with a fixed representation, so equal inputs always hash the same
+    if(isinstance(obj, dict)):
+        return {str(k): _canonical(v) for k, v in sorted(obj.items())}
+    if(isinstance(obj, (list, tuple))):
+        return [_canonical(v) for v in obj]
+    if(isinstance(obj, np.ndarray)):
+        return _canonical(obj.tolist())
+    if(isinstance(obj, (bool, np.bool_))):
+        return bool(obj)
+    if(isinstance(obj, (int, np.integer))):
+        return int(obj)
+    if(isinstance(obj, (float, np.floating))):
+        return repr(float(obj))
+    return obj if obj is None else str(obj)
+
+
+def cosmology_params(cosmo):
+    # the parameters of a colossus cosmology that change its predictions, whatever it is called
+    params = ('flat', 'H0', 'Om0', 'Ode0', 'Ob0', 'sigma8', 'ns', 'Tcmb0', 'Neff', 'relspecies', 'de_model', 'w0', 'wa', 'power_law', 'power_law_n')
+    return {k: getattr(cosmo, k, None) for k in params}
+
+
+def cache_key(inputs):
+    # sha256 of the canonical JSON of the inputs dict
+    inputs = dict(inputs, cache_version=cache_version)
+    return hashlib.sha256(json.dumps(_canonical(inputs), sort_keys=True).encode()).hexdigest()
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _version(pkg):
+    try:
+        from importlib.metadata import version # python >= 3.8
+        return version(pkg)
+    except Exception:
+        return None
+
+
+def cache_lookup(cache_dir, key):
+    # the cached arrays for key as a dict, or None on a miss; a hit counts as a use for the LRU eviction
+    fn = Path(cache_dir) / (key + '.npz')
+    meta = Path(cache_dir) / (key + '.json')
+    if(not (os.path.isfile(fn) and os.path.isfile(meta))):
+        return None
+    os.utime(meta)
+    with np.load(fn) as d:
+        return {k: d[k] for k in d.files}
+
+
+def cache_store(cache_dir, key, inputs, arrays, budget_bytes=None, **provenance):
+    '''
+    Save arrays under key with the inputs and provenance (time, host, git commit, versions,
+    plus anything passed as keyword arguments) in <key>.json, then evict the least
+    recently used entries until the cache is within budget_bytes (None for no limit).
+    '''
+    cache_dir = Path(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = cache_dir / ('.%s.%d.tmp' % (key, os.getpid()))
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, cache_dir / (key + '.npz'))
+
+    meta = {'key': key, 'inputs': _canonical(inputs), 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': socket.gethostname(), 'git_commit': _git_commit(), 'python': sys.version.split()[0],
+            'versions': {pkg: _version(pkg) for pkg in ('numpy', 'scipy', 'colossus', 'numba')}}
+    meta.update(_canonical(provenance))
+    tmp = cache_dir / ('.%s.json.%d.tmp' % (key, os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, cache_dir / (key + '.json'))
+    if(budget_bytes is not None):
+        evict_lru(cache_dir, budget_bytes, keep=key)
+
+
+def evict_lru(cache_dir, budget_bytes, keep=None):
+    # remove entries, least recently used first, until the .npz files add up to at most budget_bytes
+    entries = []
+    for meta in Path(cache_dir).glob('*.json'):
+        fn = meta.with_suffix('.npz')
+        if(os.path.isfile(fn)):
+            entries.append((os.stat(meta).st_mtime, os.stat(fn).st_size, meta.stem))
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+        if(total <= budget_bytes):
+            break
+        if(key == keep):
+            continue
+        os.remove(Path(cache_dir) / (key + '.npz'))
+        os.remove(Path(cache_dir) / (key + '.json'))
+        total -= size
+    return total
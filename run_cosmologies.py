@@ -0,0 +1,68 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from colossus.cosmology import cosmology
+import gen_mc_observables as gmo
+from nth_kernels import limit_threads
+from run_cache import cache_key
+
+# runs gen_obs for a list of cosmologies in one job: each pool worker imports everything and builds the colossus
+# tables once, then keeps its compiled kernel and projection operators across the cosmologies it is handed;
+# results go through the gen_obs result cache, so cosmologies that were already run are only read back
+
+def register_cosmologies(config):
+    # config maps new names to parameters, e.g. {"planck18_mO": {"base": "planck18", "Om0": 0.3}}
+    for name, params in config.items():
+        params = dict(params)
+        fiducial_params = cosmology.cosmologies[params.pop('base', 'planck18')].copy()
+        fiducial_params.update(params)
+        cosmology.addCosmology(name, fiducial_params)
+
+def _init_worker(config, nproc):
+    register_cosmologies(config)
+    limit_threads(nproc)
+
+def run_cosmology(task):
+    # gen_obs for one cosmology, saved to <cname>_data.npz as by gen_mc_observables.py; returns its summary index entry
+    cname, out_dir, cache_dir, cache_budget, Nbatch = task
+    cosmo = cosmology.setCosmology(cname)
+    t0 = time.time()
+    data, cvirs, Rvirs = gmo.cached_gen_obs(cosmo, cache_dir, cache_budget, Nbatch=Nbatch)
+    fn = os.path.join(out_dir, '%s_data.npz' % cname)
+    np.savez(fn, data=data, cvirs=cvirs, Rvirs=Rvirs)
+    return {'cosmology': cname, 'file': fn, 'key': cache_key(gmo.run_inputs(cosmo)), 'runtime_s': time.time() - t0,
+            'params': cosmology.cosmologies[cname]}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='gen_mc_observables.py for several cosmologies in one job')
+    parser.add_argument('cnames', nargs='*', help='cosmology names, default all of gen_mc_observables.paper_cosmologies')
+    parser.add_argument('--config', default=None, help='JSON file of extra cosmologies {name: {"base": cname, param: value}}, all run unless cnames are given')
+    parser.add_argument('--workers', type=int, default=1, help='number of cosmologies run at the same time')
+    parser.add_argument('--nbatch', type=int, default=gmo.Nbatch, help='haloes per block, 0 to integrate one halo at a time')
+    parser.add_argument('--out-dir', default='.', help='where the <cname>_data.npz files and the index go')
+    parser.add_argument('--cache-dir', default='obs_cache', help='result cache directory')
+    parser.add_argument('--cache-gb', type=float, default=20., help='size budget of the result cache in GB')
+    args = parser.parse_args()
+
+    config = {}
+    if(args.config is not None):
+        with open(args.config) as f:
+            config = json.load(f)
+    register_cosmologies(config)
+    cnames = args.cnames or gmo.paper_cosmologies + list(config)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    tasks = [(cname, args.out_dir, args.cache_dir, args.cache_gb * 1e9, args.nbatch or None) for cname in cnames]
+    if(args.workers > 1):
+        with Pool(args.workers, initializer=_init_worker, initargs=(config, args.workers)) as pool:
+            index = pool.map(run_cosmology, tasks, chunksize=1)
+    else:
+        index = [run_cosmology(task) for task in tasks]
+
+    with open(os.path.join(args.out_dir, 'cosmology_runs.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+    for entry in index:
+        print('%-16s %8.1f s  %s' % (entry['cosmology'], entry['runtime_s'], entry['file']), flush=True)